@@ -0,0 +1,116 @@
+"""Shows that Kubernetes-bound handlers no longer queue behind the threadpool.
+
+Runs main.py under uvicorn against benchmarks/fake_kube.py with a fixed per-call latency, submits more
+concurrent /update-resources operations than the default AnyIO threadpool has workers (40), waits for
+all of them to finish, and measures how long /ready takes to answer while they are in flight.
+
+Operations are queued in Postgres: pass --database-url, or have initdb/pg_ctl on PATH and a throwaway cluster is
+started in a temporary directory, as benchmarks/load.py does.
+
+    python benchmarks/async_concurrency.py --requests 200 --latency 0.5
+"""
+import argparse
+import asyncio
+import os
+import sys
+import threading
+import time
+
+import aiohttp
+import uvicorn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.fake_kube import FakeKube, serve  # noqa: E402
+from benchmarks.load import Postgres  # noqa: E402
+
+THREADPOOL_LIMIT = 40
+
+
+def start_app(port):
+    import main
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, thread
+
+
+async def run(args):
+    url = f"http://127.0.0.1:{args.port}"
+    body = {"cpu_request": "100m", "cpu_limit": "200m",
+            "memory_request": "128Mi", "memory_limit": "256Mi"}
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+        async def update(app_name):
+            async with session.post(f"{url}/update-resources", json=dict(body, app_name=app_name)) as response:
+                if response.status != 202:
+                    return f"HTTP {response.status}"
+                status_url = (await response.json())["status_url"]
+            while True:
+                async with session.get(f"{url}{status_url}") as response:
+                    operation = await response.json()
+                if operation["state"] in ("succeeded", "failed"):
+                    return operation["state"]
+                await asyncio.sleep(0.25)
+
+        async def ready():
+            start = time.perf_counter()
+            async with session.get(f"{url}/ready") as response:
+                await response.read()
+            return time.perf_counter() - start
+
+        start = time.perf_counter()
+        updates = [asyncio.create_task(update(f"tenant-{i}")) for i in range(args.requests)]
+        await asyncio.sleep(args.latency / 2)
+        ready_latency = await ready()
+        statuses = await asyncio.gather(*updates)
+        elapsed = time.perf_counter() - start
+
+    # Each update is a read plus a replace, so one request costs two round trips.
+    serial_cost = args.requests * 2 * args.latency
+    print(f"requests:            {args.requests} ({statuses.count('succeeded')} ok)")
+    for status in sorted(set(statuses) - {"succeeded"}):
+        print(f"  {status}: {statuses.count(status)}")
+    print(f"kube latency:        {args.latency:.3f}s per call")
+    print(f"wall time:           {elapsed:.3f}s")
+    print(f"effective in flight: {serial_cost / elapsed:.1f} (threadpool limit {THREADPOOL_LIMIT})")
+    print(f"/ready under load:   {ready_latency * 1000:.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--database-url", default=None, help="Postgres for the operation queue")
+    args = parser.parse_args()
+
+    postgres = None
+    database_url = args.database_url
+    if database_url is None:
+        if not Postgres.available():
+            parser.error("operations are queued in Postgres: pass --database-url or put initdb and pg_ctl on PATH")
+        postgres = Postgres()
+        postgres.start()
+        database_url = postgres.url
+    os.environ["DATABASE_URL"] = os.environ["MASTER_DATABASE_URL"] = database_url
+
+    # Operations for different tenants run in parallel up to the worker pool size.
+    os.environ.setdefault("OPERATION_WORKERS", str(args.requests))
+    fake = FakeKube(latency=args.latency)
+    fake.seed(tenants=args.requests, pods_per_tenant=1)
+    os.environ["KUBECONFIG"] = serve(fake)
+    try:
+        server, thread = start_app(args.port)
+        try:
+            asyncio.run(run(args))
+        finally:
+            server.should_exit = True
+            thread.join()
+    finally:
+        if postgres is not None:
+            postgres.stop()
+
+
+if __name__ == "__main__":
+    main()
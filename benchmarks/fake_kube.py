@@ -0,0 +1,316 @@
+"""A small in-memory stand-in for the Kubernetes API server, good enough to drive main.py in benchmarks.
+
+Run it as its own process (so it doesn't share a GIL with the app under test) with
+
+    python -m benchmarks.fake_kube --tenants 1000 --pods 3 --latency 0.005
+
+which prints the path of a kubeconfig pointing at it and serves until killed.
+"""
+import argparse
+import asyncio
+import base64
+import itertools
+import json
+import os
+import random
+import re
+import tempfile
+import threading
+from aiohttp import web
+
+OBJECT_PATH = r"/{prefix:(api/v1|apis/[^/]+/v1)}/namespaces/{namespace}/{plural}"
+KINDS = {
+    "statefulsets": ("apps/v1", "StatefulSet"),
+    "pods": ("v1", "Pod"),
+    "secrets": ("v1", "Secret"),
+    "configmaps": ("v1", "ConfigMap"),
+    "services": ("v1", "Service"),
+    "ingresses": ("networking.k8s.io/v1", "Ingress"),
+    "persistentvolumeclaims": ("v1", "PersistentVolumeClaim"),
+}
+
+
+def _matches(labels, selector):
+    for term in re.findall(r"[^,(]+(?:\([^)]*\))?", selector or ""):
+        term = term.strip()
+        if not term:
+            continue
+        if " in " in term:
+            key, values = term.split(" in ", 1)
+            if labels.get(key.strip()) not in {value.strip() for value in values.strip("() ").split(",")}:
+                return False
+        elif "=" in term:
+            key, value = term.split("=", 1)
+            if labels.get(key) != value:
+                return False
+        elif term not in labels:
+            return False
+    return True
+
+
+class FakeKube:
+    def __init__(self, latency=0.0, max_inflight=None):
+        self.latency = latency
+        # Like API priority and fairness: beyond max_inflight concurrent requests, answer 429.
+        self.max_inflight = max_inflight
+        self.inflight = 0
+        self.throttled = 0
+        self.objects = {plural: {} for plural in KINDS}
+        self.watchers = {plural: set() for plural in KINDS}
+        self.requests = 0
+        self.writes = 0
+        # Pod name -> (CPU cores, memory bytes) served by the metrics API, instead of the made-up default
+        self.usage = {}
+        self._versions = itertools.count(1)
+
+    def app(self):
+        app = web.Application(middlewares=[self.throttle])
+        app.router.add_get("/version", self.version)
+        app.router.add_get("/version/", self.version)
+        app.router.add_get("/apis/metrics.k8s.io/v1beta1/namespaces/{namespace}/pods", self.pod_metrics)
+        app.router.add_get(OBJECT_PATH, self.list)
+        app.router.add_post(OBJECT_PATH, self.create)
+        app.router.add_get(OBJECT_PATH + "/{name}", self.read)
+        app.router.add_put(OBJECT_PATH + "/{name}", self.replace)
+        app.router.add_patch(OBJECT_PATH + "/{name}", self.patch)
+        app.router.add_delete(OBJECT_PATH + "/{name}", self.delete)
+        return app
+
+    def put(self, plural, obj, event="ADDED"):
+        self.writes += 1
+        api_version, kind = KINDS[plural]
+        obj.setdefault("apiVersion", api_version)
+        obj.setdefault("kind", kind)
+        obj["metadata"].setdefault("namespace", "default")
+        obj["metadata"]["resourceVersion"] = str(next(self._versions))
+        if "stringData" in obj:
+            # Like the API server, store secrets' stringData as base64 data
+            obj.setdefault("data", {}).update({key: base64.b64encode(value.encode()).decode()
+                                               for key, value in obj.pop("stringData").items()})
+        self.objects[plural][obj["metadata"]["name"]] = obj
+        self._notify(plural, event, obj)
+        return obj
+
+    def _notify(self, plural, event, obj):
+        for queue in self.watchers[plural]:
+            queue.put_nowait({"type": event, "object": obj})
+
+    def seed(self, tenants, pods_per_tenant):
+        for i in range(tenants):
+            app_name = f"tenant-{i}"
+            self.put("statefulsets", {
+                "metadata": {"name": f"{app_name}-statefulset"},
+                "spec": {"replicas": pods_per_tenant, "serviceName": f"{app_name}-service",
+                         "selector": {"matchLabels": {"app": app_name, "monitor": "true"}},
+                         "template": {"metadata": {"labels": {"app": app_name, "monitor": "true"}},
+                                      "spec": {"containers": [{"name": f"{app_name}-container",
+                                                               "image": "postgres:16",
+                                                               "ports": [{"containerPort": 5432}]}]}}},
+                "status": {"replicas": pods_per_tenant, "readyReplicas": pods_per_tenant},
+            })
+            for j in range(pods_per_tenant):
+                self.put("pods", {
+                    "metadata": {"name": f"{app_name}-statefulset-{j}", "labels": {"app": app_name, "monitor": "true"}},
+                    "spec": {"containers": [{"name": f"{app_name}-container", "image": "postgres:16"}]},
+                    "status": {"phase": "Running", "hostIP": "10.0.0.1", "podIP": f"10.1.{i % 250}.{j}",
+                               "startTime": "2024-01-01T00:00:00Z"},
+                })
+
+    @web.middleware
+    async def throttle(self, request, handler):
+        if request.query.get("watch") in ("true", "1"):
+            return await handler(request)
+        if self.max_inflight is not None and self.inflight >= self.max_inflight:
+            self.throttled += 1
+            response = self._status(429, "TooManyRequests")
+            response.headers["Retry-After"] = "1"
+            return response
+        self.inflight += 1
+        try:
+            return await handler(request)
+        finally:
+            self.inflight -= 1
+
+    async def _delay(self):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def pod_metrics(self, request):
+        await self._delay()
+        selector = request.query.get("labelSelector")
+        items = []
+        for pod in self.objects["pods"].values():
+            labels = pod["metadata"].get("labels") or {}
+            if not _matches(labels, selector):
+                continue
+            name = pod["metadata"]["name"]
+            if name in self.usage:
+                cpu, memory = self.usage[name]
+            else:
+                # Steady per-pod usage with some jitter, so percentiles have something to work with
+                seed = sum(map(ord, name))
+                cpu = (0.05 + seed % 40 / 100) * random.uniform(0.8, 1.2)
+                memory = (128 + seed % 512) * 2 ** 20 * random.uniform(0.9, 1.1)
+            items.append({
+                "metadata": {"name": name, "namespace": "default", "labels": labels},
+                "timestamp": "2024-01-01T00:00:00Z", "window": "15s",
+                "containers": [{"name": container["name"],
+                                "usage": {"cpu": f"{int(cpu * 1e9)}n", "memory": f"{int(memory / 1024)}Ki"}}
+                               for container in pod["spec"]["containers"]],
+            })
+        return web.json_response({"kind": "PodMetricsList", "apiVersion": "metrics.k8s.io/v1beta1",
+                                  "metadata": {}, "items": items})
+
+    async def version(self, request):
+        await self._delay()
+        return web.json_response({"major": "1", "minor": "30", "gitVersion": "v1.30.0-fake", "gitCommit": "fake",
+                                  "gitTreeState": "clean", "buildDate": "2024-01-01T00:00:00Z",
+                                  "goVersion": "go1.22", "compiler": "gc", "platform": "linux/amd64"})
+
+    async def list(self, request):
+        plural = request.match_info["plural"]
+        if request.query.get("watch") in ("true", "1"):
+            return await self.watch(request, plural)
+        await self._delay()
+        items = [obj for obj in self.objects[plural].values()
+                 if _matches(obj["metadata"].get("labels") or {}, request.query.get("labelSelector"))]
+        start = int(request.query.get("continue") or 0)
+        limit = int(request.query.get("limit") or 0)
+        page = items[start:start + limit] if limit else items[start:]
+        metadata = {"resourceVersion": str(next(self._versions))}
+        if limit and start + limit < len(items):
+            metadata["continue"] = str(start + limit)
+        api_version, kind = KINDS[plural]
+        return web.json_response({"apiVersion": api_version, "kind": f"{kind}List", "metadata": metadata,
+                                  "items": page})
+
+    async def watch(self, request, plural):
+        response = web.StreamResponse(headers={"Content-Type": "application/json"})
+        await response.prepare(request)
+        queue = asyncio.Queue()
+        self.watchers[plural].add(queue)
+        timeout = float(request.query.get("timeoutSeconds") or 300)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        try:
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    event = await asyncio.wait_for(queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                await response.write(json.dumps(event).encode() + b"\n")
+        finally:
+            self.watchers[plural].discard(queue)
+        return response
+
+    async def read(self, request):
+        await self._delay()
+        obj = self.objects[request.match_info["plural"]].get(request.match_info["name"])
+        if obj is None:
+            return self._status(404, "NotFound")
+        return web.json_response(obj)
+
+    async def create(self, request):
+        await self._delay()
+        plural = request.match_info["plural"]
+        obj = await request.json()
+        if obj["metadata"]["name"] in self.objects[plural]:
+            return self._status(409, "AlreadyExists")
+        return web.json_response(self.put(plural, obj), status=201)
+
+    async def replace(self, request):
+        await self._delay()
+        plural = request.match_info["plural"]
+        if request.match_info["name"] not in self.objects[plural]:
+            return self._status(404, "NotFound")
+        return web.json_response(self.put(plural, await request.json(), "MODIFIED"))
+
+    async def patch(self, request):
+        await self._delay()
+        plural = request.match_info["plural"]
+        current = self.objects[plural].get(request.match_info["name"])
+        if request.query.get("dryRun") == "All":
+            return web.json_response(_merge(json.loads(json.dumps(current or {})), await request.json()))
+        if current is None:
+            if request.content_type == "application/apply-patch+yaml":
+                # Server-side apply creates what doesn't exist
+                return web.json_response(self.put(plural, await request.json()), status=201)
+            return self._status(404, "NotFound")
+        merged = _merge(json.loads(json.dumps(current)), await request.json())
+        return web.json_response(self.put(plural, merged, "MODIFIED"))
+
+    async def delete(self, request):
+        await self._delay()
+        plural = request.match_info["plural"]
+        obj = self.objects[plural].pop(request.match_info["name"], None)
+        if obj is None:
+            return self._status(404, "NotFound")
+        self._notify(plural, "DELETED", obj)
+        return web.json_response(obj)
+
+    @staticmethod
+    def _status(code, reason):
+        return web.json_response({"kind": "Status", "apiVersion": "v1", "status": "Failure", "reason": reason,
+                                  "code": code, "message": reason}, status=code)
+
+
+def _merge(target, patch):
+    for key, value in patch.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        else:
+            target[key] = value
+    return target
+
+
+def serve(fake, port=0):
+    """Run `fake` on a background thread and return a kubeconfig path pointing at it."""
+    started = threading.Event()
+    bound = {}
+
+    def run():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        runner = web.AppRunner(fake.app())
+        loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, "127.0.0.1", port)
+        loop.run_until_complete(site.start())
+        bound["port"] = site._server.sockets[0].getsockname()[1]
+        fake.loop = loop
+        started.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, name="fake-kube", daemon=True).start()
+    started.wait()
+    kubeconfig = {
+        "apiVersion": "v1", "kind": "Config", "current-context": "fake",
+        "clusters": [{"name": "fake", "cluster": {"server": f"http://127.0.0.1:{bound['port']}"}}],
+        "contexts": [{"name": "fake", "context": {"cluster": "fake", "user": "fake"}}],
+        "users": [{"name": "fake", "user": {"token": "fake"}}],
+    }
+    fd, path = tempfile.mkstemp(suffix=".kubeconfig")
+    with os.fdopen(fd, "w") as f:
+        json.dump(kubeconfig, f)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tenants", type=int, default=10)
+    parser.add_argument("--pods", type=int, default=1, help="pods per tenant")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--max-inflight", type=int, default=None)
+    parser.add_argument("--port", type=int, default=0)
+    args = parser.parse_args()
+    fake = FakeKube(latency=args.latency, max_inflight=args.max_inflight)
+    fake.seed(args.tenants, args.pods)
+    print(serve(fake, args.port), flush=True)
+    threading.Event().wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,370 @@
+"""Latency and throughput of the main endpoints at increasing tenant counts, with results saved for comparison.
+
+For every tenant count this starts a fresh fake Kubernetes API (benchmarks/fake_kube.py) and a fresh uvicorn
+running main.py, each in its own process, then drives every scenario for a fixed time at a fixed concurrency
+and reports p50/p99 latency and requests per second.
+
+/health/{app} and the deploy and update scenarios need Postgres, which also holds the operation queue: pass
+--database-url, or have initdb/pg_ctl on PATH and a throwaway cluster is started in a temporary directory. Without
+either, those scenarios are skipped. Deploys and updates are accepted with 202 and run in the background, so for
+them each worker also polls /operations/{id} until the operation has finished, and the time from submission to
+then is reported as completion latency next to the latency of the request itself.
+
+    python -m benchmarks.load --tenants 10,100,1000,10000 --duration 10 --concurrency 32
+    python -m benchmarks.load --tenants 1000 --compare benchmarks/results/20240101T000000Z.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import aiohttp
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+SCENARIOS = ("status_all", "status_app", "deploy", "update_resources", "health_app")
+DATABASE_SCENARIOS = {"deploy", "update_resources", "health_app"}
+# Scenarios whose requests queue an operation instead of doing the work
+OPERATION_SCENARIOS = {"deploy", "update_resources"}
+OPERATION_POLL_SECONDS = 0.02
+RESOURCES = {"cpu_request": "100m", "cpu_limit": "200m", "memory_request": "128Mi", "memory_limit": "256Mi"}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+class Postgres:
+    """A throwaway Postgres cluster in a temporary directory, for when no --database-url is given."""
+
+    def __init__(self):
+        self.directory = tempfile.mkdtemp(prefix="kaas-bench-pg-")
+        self.port = free_port()
+        self.url = f"postgresql://postgres@127.0.0.1:{self.port}/postgres"
+
+    @staticmethod
+    def available():
+        return shutil.which("initdb") is not None and shutil.which("pg_ctl") is not None
+
+    def start(self):
+        data = os.path.join(self.directory, "data")
+        subprocess.run(["initdb", "-D", data, "-U", "postgres", "--auth=trust"], check=True, capture_output=True)
+        subprocess.run(["pg_ctl", "-D", data, "-w", "-l", os.path.join(self.directory, "log"),
+                        "-o", f"-p {self.port} -k {self.directory} -c fsync=off", "start"],
+                       check=True, capture_output=True)
+
+    def stop(self):
+        subprocess.run(["pg_ctl", "-D", os.path.join(self.directory, "data"), "-m", "fast", "stop"],
+                       capture_output=True)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+async def prepare_database(url, tenants):
+    """Create the app's own health schema, give every tenant a health row and empty the operation queue."""
+    import asyncpg
+    os.environ["DATABASE_URL"] = os.environ["MASTER_DATABASE_URL"] = url
+    sys.path.insert(0, ROOT)
+    import db
+    import health_store
+
+    connection = await asyncpg.connect(url)
+    try:
+        await connection.execute("DROP TABLE IF EXISTS health, health_event, health_rollup, operation CASCADE")
+    finally:
+        await connection.close()
+    await db.open_pools()
+    try:
+        await db.ensure_schema("health", health_store.SCHEMA)
+        names = [f"tenant-{i}" for i in range(tenants)]
+        now = datetime.now()
+        async with db.write("prepare_benchmark") as connection:
+            await health_store.maintain_partitions(connection, now.date())
+            await connection.execute(health_store.UPSERT_HEALTH, names, [1] * tenants, [0] * tenants,
+                                     [now] * tenants, [None] * tenants, [now] * tenants, [None] * tenants)
+    finally:
+        await db.close_pools()
+
+
+class Environment:
+    """The fake API server and the app under test, each in its own process."""
+
+    def __init__(self, args, tenants, database_url):
+        self.args = args
+        self.tenants = tenants
+        self.database_url = database_url
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self._processes = []
+
+    def start(self):
+        fake = subprocess.Popen(
+            [sys.executable, "-m", "benchmarks.fake_kube", "--tenants", str(self.tenants),
+             "--pods", str(self.args.pods), "--latency", str(self.args.latency)],
+            cwd=ROOT, stdout=subprocess.PIPE, text=True
+        )
+        self._processes.append(fake)
+        kubeconfig = fake.stdout.readline().strip()
+        env = dict(os.environ, KUBECONFIG=kubeconfig, HEALTH_PROBE_TCP="false",
+                   DATABASE_URL=self.database_url or "sqlite://", MASTER_DATABASE_URL=self.database_url or "sqlite://")
+        app = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(self.port),
+             "--log-level", "warning"],
+            cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=None if self.args.verbose else subprocess.DEVNULL
+        )
+        self._processes.append(app)
+
+    def stop(self):
+        for process in reversed(self._processes):
+            process.terminate()
+        for process in self._processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    async def wait_ready(self, session, timeout=120):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(self.url + "/status/", params={"limit": "1"}) as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+        raise RuntimeError(f"app did not become ready within {timeout}s")
+
+
+def scenario_requests(scenario, tenants):
+    """An endless supply of (method, path, json) for `scenario`."""
+    counter = 0
+    while True:
+        counter += 1
+        app_name = f"tenant-{random.randrange(tenants)}"
+        if scenario == "status_all":
+            yield "GET", "/status/", None
+        elif scenario == "status_app":
+            yield "GET", f"/status/{app_name}", None
+        elif scenario == "health_app":
+            yield "GET", f"/health/{app_name}", None
+        elif scenario == "update_resources":
+            yield "POST", "/update-resources", dict(RESOURCES, app_name=app_name)
+        elif scenario == "deploy":
+            yield "POST", "/deploy-application", dict(
+                RESOURCES, app_name=f"bench-{os.getpid()}-{counter}", replicas=1, user="bench", password="bench",
+                db_name="bench", image_address="postgres", image_tag="16", domain_address="bench.local",
+                service_port=5432, external_access=False, monitor=False
+            )
+
+
+async def wait_for_operation(session, base_url, operation_id):
+    """Poll the operation until it has finished and return its final state."""
+    while True:
+        async with session.get(f"{base_url}/operations/{operation_id}") as response:
+            operation = await response.json()
+        if response.status != 200:
+            return "missing"
+        if operation["state"] in ("succeeded", "failed"):
+            return operation["state"]
+        await asyncio.sleep(OPERATION_POLL_SECONDS)
+
+
+async def drive(session, base_url, scenario, tenants, duration, concurrency):
+    requests = scenario_requests(scenario, tenants)
+    latencies = []
+    completions = []
+    statuses = {}
+    outcomes = {}
+    deadline = time.perf_counter() + duration
+
+    async def worker():
+        while time.perf_counter() < deadline:
+            method, path, body = next(requests)
+            start = time.perf_counter()
+            operation_id = None
+            try:
+                async with session.request(method, base_url + path, json=body) as response:
+                    payload = await response.read()
+                    status = str(response.status)
+                    if response.status == 202:
+                        operation_id = json.loads(payload)["operation_id"]
+            except aiohttp.ClientError as e:
+                status = type(e).__name__
+            latencies.append(time.perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+            if operation_id is not None:
+                try:
+                    outcome = await wait_for_operation(session, base_url, operation_id)
+                except aiohttp.ClientError as e:
+                    outcome = type(e).__name__
+                completions.append(time.perf_counter() - start)
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    p50, p99 = percentile(latencies, 0.50), percentile(latencies, 0.99)
+    result = {
+        "tenants": tenants,
+        "scenario": scenario,
+        "requests": len(latencies),
+        "errors": sum(count for status, count in statuses.items() if not status.startswith("2")),
+        "statuses": statuses,
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(p50 * 1000, 2) if p50 is not None else None,
+        "p99_ms": round(p99 * 1000, 2) if p99 is not None else None,
+    }
+    if scenario in OPERATION_SCENARIOS:
+        completions.sort()
+        p50, p99 = percentile(completions, 0.50), percentile(completions, 0.99)
+        result.update({
+            "operations": outcomes,
+            "failed_operations": sum(count for outcome, count in outcomes.items() if outcome != "succeeded"),
+            "completion_p50_ms": round(p50 * 1000, 2) if p50 is not None else None,
+            "completion_p99_ms": round(p99 * 1000, 2) if p99 is not None else None,
+        })
+    return result
+
+
+async def run_tenant_count(args, tenants, database_url):
+    if database_url:
+        await prepare_database(database_url, tenants)
+    environment = Environment(args, tenants, database_url)
+    environment.start()
+    results = []
+    try:
+        connector = aiohttp.TCPConnector(limit=0)
+        timeout = aiohttp.ClientTimeout(total=args.request_timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            await environment.wait_ready(session)
+            for scenario in args.scenarios:
+                if scenario in DATABASE_SCENARIOS and not database_url:
+                    print(f"{tenants:>6} {scenario:<17} skipped: no database", flush=True)
+                    continue
+                await drive(session, environment.url, scenario, tenants, args.warmup, args.concurrency)
+                result = await drive(session, environment.url, scenario, tenants, args.duration, args.concurrency)
+                results.append(result)
+                print(format_result(result), flush=True)
+    finally:
+        environment.stop()
+    return results
+
+
+def format_result(result):
+    line = (f"{result['tenants']:>6} {result['scenario']:<17} {result['rps']:>9.1f} rps  "
+            f"p50 {result['p50_ms'] or 0:>8.2f} ms  p99 {result['p99_ms'] or 0:>8.2f} ms  errors {result['errors']}")
+    if "operations" in result:
+        line += (f"\n{'':>6} {'  completed':<17} {'':>13}  p50 {result['completion_p50_ms'] or 0:>8.2f} ms  "
+                 f"p99 {result['completion_p99_ms'] or 0:>8.2f} ms  failed {result['failed_operations']}")
+    return line
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path, threshold):
+    """Print the change against a saved run and return how many results regressed by more than `threshold`."""
+    with open(baseline_path) as f:
+        baseline = {(row["tenants"], row["scenario"]): row for row in json.load(f)["results"]}
+    regressions = 0
+    print(f"\ncompared with {baseline_path} (regression threshold {threshold:.0%})")
+    for result in results:
+        before = baseline.get((result["tenants"], result["scenario"]))
+        if before is None or not before["p99_ms"] or not before["rps"]:
+            continue
+        p99_change = result["p99_ms"] / before["p99_ms"] - 1
+        rps_change = result["rps"] / before["rps"] - 1
+        regressed = p99_change > threshold or rps_change < -threshold
+        line = f"{result['tenants']:>6} {result['scenario']:<17} p99 {p99_change:+8.1%}  rps {rps_change:+8.1%}"
+        if result.get("completion_p99_ms") and before.get("completion_p99_ms"):
+            completion_change = result["completion_p99_ms"] / before["completion_p99_ms"] - 1
+            regressed = regressed or completion_change > threshold
+            line += f"  completion p99 {completion_change:+8.1%}"
+        regressions += regressed
+        print(f"{line}{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tenants", default="10,100,1000,10000", help="comma-separated tenant counts")
+    parser.add_argument("--pods", type=int, default=3, help="pods per tenant")
+    parser.add_argument("--latency", type=float, default=0.005, help="seconds the fake API adds to each request")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--duration", type=float, default=10.0, help="measured seconds per scenario")
+    parser.add_argument("--warmup", type=float, default=2.0, help="unmeasured seconds before each scenario")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--request-timeout", type=float, default=60.0)
+    parser.add_argument("--database-url", default=None, help="Postgres for /health/{app} and the operation queue; rebuilt per run")
+    parser.add_argument("--output", default=None, help="where to save results (default benchmarks/results/)")
+    parser.add_argument("--compare", default=None, help="a saved result file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="relative p99/rps change counted as regression")
+    parser.add_argument("--verbose", action="store_true", help="show the app's logs")
+    args = parser.parse_args()
+    args.scenarios = [scenario for scenario in args.scenarios.split(",") if scenario]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    postgres = None
+    database_url = args.database_url
+    if database_url is None and DATABASE_SCENARIOS & set(args.scenarios) and Postgres.available():
+        postgres = Postgres()
+        postgres.start()
+        database_url = postgres.url
+
+    results = []
+    try:
+        for tenants in (int(count) for count in args.tenants.split(",")):
+            results.extend(await run_tenant_count(args, tenants, database_url))
+    finally:
+        if postgres is not None:
+            postgres.stop()
+
+    finished = datetime.now(timezone.utc)
+    output = args.output or os.path.join(RESULTS_DIR, f"{finished:%Y%m%dT%H%M%SZ}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({
+            "meta": {
+                "revision": git_revision(),
+                "finished_at": finished.isoformat(),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "cpus": os.cpu_count(),
+                "database": "postgres" if database_url else None,
+                **{key: value for key, value in vars(args).items() if key not in ("output", "compare", "verbose")},
+            },
+            "results": results,
+        }, f, indent=2)
+    print(f"\nsaved {output}")
+
+    if args.compare and compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
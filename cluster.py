@@ -0,0 +1,6 @@
+import os
+
+
+def in_cluster():
+    # An explicit KUBECONFIG wins, so a pod can still be pointed at another cluster
+    return "KUBECONFIG" not in os.environ and "KUBERNETES_SERVICE_HOST" in os.environ
@@ -0,0 +1,114 @@
+import os
+import asyncio
+import logging
+import time
+from datetime import datetime, timezone
+from kubernetes.aio.client.exceptions import ApiException
+from prometheus_client import Counter, Gauge, Histogram
+from metrics import DB_BUCKETS
+import db
+import kube
+
+logger = logging.getLogger(__name__)
+
+DEPENDENCY_CHECK_INTERVAL_SECONDS = float(os.getenv("DEPENDENCY_CHECK_INTERVAL_SECONDS", "5"))
+DEPENDENCY_CHECK_TIMEOUT_SECONDS = float(os.getenv("DEPENDENCY_CHECK_TIMEOUT_SECONDS", "2"))
+# Results older than this are not trusted, and a checker that hasn't finished a cycle in this long is stuck
+DEPENDENCY_STALE_SECONDS = 3 * DEPENDENCY_CHECK_INTERVAL_SECONDS + DEPENDENCY_CHECK_TIMEOUT_SECONDS
+
+DEPENDENCY_CHECK_LATENCY = Histogram("dependency_check_seconds", "Latency of background dependency checks in seconds",
+                                     ["dependency"], buckets=DB_BUCKETS)
+DEPENDENCY_CHECK_FAILURES = Counter("dependency_check_failures_total", "Failed background dependency checks",
+                                    ["dependency"])
+DEPENDENCY_UP = Gauge("dependency_up", "1 if the last check of the dependency succeeded", ["dependency"],
+                      multiprocess_mode="livemin")
+
+
+async def check_database():
+    async with db.master_pool.acquire() as connection:
+        await connection.fetchval("SELECT 1")
+
+
+async def check_kubernetes():
+    await kube.call(kube.version_api.get_code, timeout=DEPENDENCY_CHECK_TIMEOUT_SECONDS)
+
+
+CHECKS = {
+    "database": check_database,
+    "kubernetes": check_kubernetes,
+}
+
+
+class DependencyChecker:
+    """Checks the database and the Kubernetes API in the background so probes can answer from the last result.
+
+    /ready needs every dependency to have passed its latest check, and that check to be recent. /healthz only
+    needs the checker itself to keep completing cycles: an unreachable dependency isn't fixed by restarting us.
+    /start passes once the first cycle has finished.
+    """
+
+    def __init__(self, checks=CHECKS, interval=DEPENDENCY_CHECK_INTERVAL_SECONDS):
+        self.checks = checks
+        self.interval = interval
+        self.results = {}
+        self.last_cycle = None
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("dependency check cycle failed")
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self):
+        results = await asyncio.gather(*(self._check(name, check) for name, check in self.checks.items()))
+        self.results = dict(zip(self.checks, results))
+        self.last_cycle = time.monotonic()
+
+    async def _check(self, name, check):
+        start = time.perf_counter()
+        error = None
+        try:
+            await asyncio.wait_for(check(), DEPENDENCY_CHECK_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            error = f"Timed out after {DEPENDENCY_CHECK_TIMEOUT_SECONDS}s"
+        except ApiException as e:
+            error = f"{e.status} {e.reason}"
+        except Exception as e:
+            error = str(e) or type(e).__name__
+        latency = time.perf_counter() - start
+        DEPENDENCY_CHECK_LATENCY.labels(dependency=name).observe(latency)
+        DEPENDENCY_UP.labels(dependency=name).set(error is None)
+        if error is not None:
+            DEPENDENCY_CHECK_FAILURES.labels(dependency=name).inc()
+            if self.results.get(name, {}).get("ok", True):
+                logger.warning("dependency %s is failing: %s", name, error)
+        return {
+            "ok": error is None,
+            "error": error,
+            "latency_seconds": round(latency, 4),
+            "checked_at": datetime.now(timezone.utc).isoformat(),
+        }
+
+    @property
+    def started(self):
+        return self.last_cycle is not None
+
+    @property
+    def alive(self):
+        return self.last_cycle is None or time.monotonic() - self.last_cycle < DEPENDENCY_STALE_SECONDS
+
+    @property
+    def ready(self):
+        return (self.started and time.monotonic() - self.last_cycle < DEPENDENCY_STALE_SECONDS
+                and all(result["ok"] for result in self.results.values()))
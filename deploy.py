@@ -0,0 +1,395 @@
+import os
+import asyncio
+import logging
+import time
+from kubernetes.aio import client
+from kubernetes.aio.client.exceptions import ApiException
+import kube
+import pg_tuning
+
+logger = logging.getLogger(__name__)
+
+NAMESPACE = "default"
+PGBOUNCER_IMAGE = os.getenv("PGBOUNCER_IMAGE", "bitnami/pgbouncer:1.23.1")
+WORKLOAD_PROFILE_ANNOTATION = "kaas/workload-profile"
+CONFIG_HASH_ANNOTATION = "kaas/postgresql-conf-hash"
+# The sidecar's environment variable holding each PgBouncer setting of ApplicationConfig
+PGBOUNCER_SETTINGS = {
+    "pgbouncer_port": "PGBOUNCER_PORT",
+    "pgbouncer_pool_mode": "PGBOUNCER_POOL_MODE",
+    "pgbouncer_pool_size": "PGBOUNCER_DEFAULT_POOL_SIZE",
+    "pgbouncer_max_client_conn": "PGBOUNCER_MAX_CLIENT_CONN",
+}
+
+
+class ConfigConflict(Exception):
+    """A redeploy asks an existing tenant for settings that are only applied when it is provisioned."""
+
+
+def build_secret(config):
+    return client.V1Secret(
+        metadata=client.V1ObjectMeta(name=f"{config.app_name}-secret"),
+        type="Opaque",
+        string_data={
+            "DB_USER": config.user,
+            "DB_PASSWORD": config.password,
+            "DB_NAME": config.db_name,
+        }
+    )
+
+
+def tuned_conf(config):
+    """The tenant's generated postgresql.conf, or None without a workload profile."""
+    if not config.workload_profile:
+        return None
+    return pg_tuning.postgresql_conf(config.workload_profile, config.memory_limit, config.cpu_limit)
+
+
+def build_config_map(config):
+    data = {
+        "DB_USER": config.user,
+        "DB_PASSWORD": config.password,
+        "DB_NAME": config.db_name,
+    }
+    conf = tuned_conf(config)
+    if conf is not None:
+        data[pg_tuning.CONFIG_KEY] = conf
+    return client.V1ConfigMap(
+        metadata=client.V1ObjectMeta(name=f"{config.app_name}-config"),
+        data=data
+    )
+
+
+def secret_env(name, app_name, key):
+    return client.V1EnvVar(
+        name=name,
+        value_from=client.V1EnvVarSource(secret_key_ref=client.V1SecretKeySelector(name=f"{app_name}-secret", key=key))
+    )
+
+
+def build_pgbouncer_container(config):
+    """PgBouncer in front of the tenant's Postgres in the same pod, so clients reach it over the Service."""
+    app_name = config.app_name
+    return client.V1Container(
+        name=f"{app_name}-pgbouncer",
+        image=PGBOUNCER_IMAGE,
+        env=[
+            secret_env("POSTGRESQL_USERNAME", app_name, "DB_USER"),
+            secret_env("POSTGRESQL_PASSWORD", app_name, "DB_PASSWORD"),
+            secret_env("POSTGRESQL_DATABASE", app_name, "DB_NAME"),
+            secret_env("PGBOUNCER_DATABASE", app_name, "DB_NAME"),
+            # Lets the tenant's own user run SHOW POOLS, which /status/{app_name} reports
+            secret_env("PGBOUNCER_STATS_USERS", app_name, "DB_USER"),
+            client.V1EnvVar(name="POSTGRESQL_HOST", value="127.0.0.1"),
+            client.V1EnvVar(name="POSTGRESQL_PORT", value=str(config.service_port)),
+            client.V1EnvVar(name="PGBOUNCER_PORT", value=str(config.pgbouncer_port)),
+            client.V1EnvVar(name="PGBOUNCER_POOL_MODE", value=config.pgbouncer_pool_mode),
+            client.V1EnvVar(name="PGBOUNCER_DEFAULT_POOL_SIZE", value=str(config.pgbouncer_pool_size)),
+            client.V1EnvVar(name="PGBOUNCER_MAX_CLIENT_CONN", value=str(config.pgbouncer_max_client_conn)),
+        ],
+        ports=[client.V1ContainerPort(name="pgbouncer", container_port=config.pgbouncer_port)],
+        resources=client.V1ResourceRequirements(
+            requests={"cpu": "50m", "memory": "32Mi"},
+            limits={"cpu": "500m", "memory": "128Mi"}
+        ),
+        readiness_probe=client.V1Probe(tcp_socket=client.V1TCPSocketAction(port=config.pgbouncer_port),
+                                       period_seconds=10)
+    )
+
+
+def build_stateful_set(config):
+    app_name = config.app_name
+    labels = {"app": app_name, 'monitor': 'true' if config.monitor else 'false'}
+    sidecars, role_env = [], []
+    if config.pgbouncer:
+        sidecars = [build_pgbouncer_container(config)]
+        # The image would otherwise create only the "postgres" role and database, and PgBouncer logs in as DB_USER
+        role_env = [secret_env("POSTGRES_USER", app_name, "DB_USER"), secret_env("POSTGRES_DB", app_name, "DB_NAME")]
+    conf = tuned_conf(config)
+    tuning, volumes = {}, None
+    if conf is not None:
+        # Postgres reads the generated file in place of the image's own, mounted from the tenant ConfigMap
+        tuning = {
+            "args": ["postgres", "-c", f"config_file={pg_tuning.CONFIG_FILE}"],
+            "volume_mounts": [client.V1VolumeMount(name="postgresql-conf", mount_path=pg_tuning.CONFIG_DIR,
+                                                   read_only=True)],
+        }
+        volumes = [client.V1Volume(
+            name="postgresql-conf",
+            config_map=client.V1ConfigMapVolumeSource(
+                name=f"{app_name}-config",
+                items=[client.V1KeyToPath(key=pg_tuning.CONFIG_KEY, path="postgresql.conf")]
+            )
+        )]
+    return client.V1StatefulSet(
+        metadata=client.V1ObjectMeta(
+            name=f"{app_name}-statefulset",
+            annotations={WORKLOAD_PROFILE_ANNOTATION: config.workload_profile} if conf is not None else None
+        ),
+        spec=client.V1StatefulSetSpec(
+            replicas=config.replicas,
+            selector=client.V1LabelSelector(match_labels=labels),
+            service_name=f"{app_name}-service",
+            template=client.V1PodTemplateSpec(
+                metadata=client.V1ObjectMeta(
+                    labels=labels,
+                    annotations={CONFIG_HASH_ANNOTATION: pg_tuning.config_hash(conf)} if conf is not None else None
+                ),
+                spec=client.V1PodSpec(volumes=volumes, containers=[
+                    client.V1Container(
+                        name=f"{app_name}-container",
+                        image=f"{config.image_address}:{config.image_tag}",
+                        env=[
+                            client.V1EnvVar(
+                                name="DB_USER",
+                                value_from=client.V1EnvVarSource(
+                                    secret_key_ref=client.V1SecretKeySelector(
+                                        name=f"{app_name}-secret",
+                                        key="DB_USER"
+                                    )
+                                )
+                            ),
+                            client.V1EnvVar(
+                                name="POSTGRES_PASSWORD",
+                                value_from=client.V1EnvVarSource(
+                                    secret_key_ref=client.V1SecretKeySelector(
+                                        name=f"{app_name}-secret",
+                                        key="DB_PASSWORD"
+                                    )
+                                )
+                            ),
+                            client.V1EnvVar(
+                                name="DB_NAME",
+                                value_from=client.V1EnvVarSource(
+                                    secret_key_ref=client.V1SecretKeySelector(
+                                        name=f"{app_name}-secret",
+                                        key="DB_NAME"
+                                    )
+                                )
+                            ),
+                            *role_env
+                        ],
+                        ports=[client.V1ContainerPort(name="db", container_port=config.service_port)],
+                        **tuning
+                    ),
+                    *sidecars
+                ])
+            )
+        )
+    )
+
+
+def build_service(config):
+    ports = [client.V1ServicePort(name="db", port=config.service_port, target_port=config.service_port)]
+    if config.pgbouncer:
+        ports.append(client.V1ServicePort(name="pgbouncer", port=config.pgbouncer_port,
+                                          target_port=config.pgbouncer_port))
+    return client.V1Service(
+        metadata=client.V1ObjectMeta(name=f"{config.app_name}-service"),
+        spec=client.V1ServiceSpec(
+            selector={"app": config.app_name},
+            ports=ports,
+            type="LoadBalancer" if config.external_access else "ClusterIP"
+        )
+    )
+
+
+def build_ingress(config):
+    return client.V1Ingress(
+        metadata=client.V1ObjectMeta(name=f"{config.app_name}-ingress"),
+        spec=client.V1IngressSpec(
+            rules=[
+                client.V1IngressRule(
+                    host=config.domain_address,
+                    http=client.V1HTTPIngressRuleValue(
+                        paths=[
+                            client.V1HTTPIngressPath(
+                                path="/",
+                                path_type="Prefix",
+                                backend=client.V1IngressBackend(
+                                    service=client.V1IngressServiceBackend(
+                                        name=f"{config.app_name}-service",
+                                        port=client.V1ServiceBackendPort(number=config.service_port)
+                                    )
+                                )
+                            )
+                        ]
+                    )
+                )
+            ]
+        )
+    )
+
+
+class Provisioning:
+    """Creates a tenant's objects in dependency order and deletes whatever it created if a step fails.
+
+    Secret, ConfigMap and Service do not depend on each other and are created together; the StatefulSet
+    needs the Secret and the Service, and the Ingress needs the Service.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.timings = {}
+        self._created = []
+
+    async def run(self):
+        config = self.config
+        try:
+            await self._stage(
+                ("secret", kube.core_v1.create_namespaced_secret, kube.core_v1.delete_namespaced_secret,
+                 build_secret(config)),
+                ("config_map", kube.core_v1.create_namespaced_config_map, kube.core_v1.delete_namespaced_config_map,
+                 build_config_map(config)),
+                ("service", kube.core_v1.create_namespaced_service, kube.core_v1.delete_namespaced_service,
+                 build_service(config)),
+            )
+            await self._stage(
+                ("stateful_set", kube.apps_v1.create_namespaced_stateful_set,
+                 kube.apps_v1.delete_namespaced_stateful_set, build_stateful_set(config)),
+            )
+            if config.external_access:
+                await self._stage(
+                    ("ingress", kube.networking_v1.create_namespaced_ingress,
+                     kube.networking_v1.delete_namespaced_ingress, build_ingress(config)),
+                )
+        except BaseException:
+            # Whatever stopped it, including a dropped connection or the operation being cancelled at shutdown,
+            # leaves no half-created tenant behind. Shielded so that the cancellation can't cut the rollback short.
+            await asyncio.shield(self.rollback())
+            raise
+        return self.timings
+
+    async def _stage(self, *steps):
+        results = await asyncio.gather(*(self._step(*step) for step in steps), return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+    async def _step(self, name, create, delete, body):
+        start = time.perf_counter()
+        try:
+            await kube.call(create, namespace=NAMESPACE, body=body)
+        except ApiException:
+            # Refused, for example because it already exists, so not ours to delete
+            raise
+        except BaseException:
+            # Timed out, cut off or cancelled: the API server may still have applied it, so treat it as ours.
+            self._created.append((delete, body.metadata.name))
+            raise
+        finally:
+            self.timings[name] = round(time.perf_counter() - start, 4)
+        self._created.append((delete, body.metadata.name))
+
+    async def rollback(self):
+        start = time.perf_counter()
+        for delete, name in reversed(self._created):
+            try:
+                await kube.call(delete, name=name, namespace=NAMESPACE)
+            except ApiException as e:
+                if e.status != 404:
+                    logger.warning("rollback of %s failed: %s", name, e)
+            except Exception:
+                logger.exception("rollback of %s failed", name)
+        self._created.clear()
+        self.timings["rollback"] = round(time.perf_counter() - start, 4)
+
+
+async def provision(config):
+    return await Provisioning(config).run()
+
+
+async def read_stateful_set(app_name):
+    return await kube.call(kube.apps_v1.read_namespaced_stateful_set, name=f"{app_name}-statefulset",
+                           namespace=NAMESPACE)
+
+
+def provisioned_changes(stateful_set, config):
+    """The fields of a deploy that differ from what the existing tenant was provisioned with."""
+    changes = []
+    # Only a tenant whose config was actually tuned carries the annotation
+    if (stateful_set.metadata.annotations or {}).get(WORKLOAD_PROFILE_ANNOTATION) != config.workload_profile:
+        changes.append("workload_profile")
+    sidecar = next((container for container in stateful_set.spec.template.spec.containers
+                    if container.name == f"{config.app_name}-pgbouncer"), None)
+    if (sidecar is not None) != config.pgbouncer:
+        changes.append("pgbouncer")
+    elif sidecar is not None:
+        env = {variable.name: variable.value for variable in sidecar.env or []}
+        changes += [field for field, name in PGBOUNCER_SETTINGS.items()
+                    if env.get(name) != str(getattr(config, field))]
+    return changes
+
+
+async def update_resources(config, annotations=None, stateful_set=None):
+    """Set the tenant container's requests and limits, plus any `annotations` on the StatefulSet itself."""
+    app_name = config.app_name
+    if stateful_set is None:
+        stateful_set = await read_stateful_set(app_name)
+    if annotations:
+        stateful_set.metadata.annotations = {**(stateful_set.metadata.annotations or {}), **annotations}
+    stateful_set.spec.template.spec.containers[0].resources = client.V1ResourceRequirements(
+        requests={"cpu": config.cpu_request, "memory": config.memory_request},
+        limits={"cpu": config.cpu_limit, "memory": config.memory_limit}
+    )
+    previous_conf = await retune(stateful_set, config)
+    try:
+        await kube.call(kube.apps_v1.replace_namespaced_stateful_set, name=f"{app_name}-statefulset",
+                        namespace=NAMESPACE, body=stateful_set)
+    except BaseException:
+        # Otherwise the new file would sit under the old limits until the pods next restart for any reason
+        if previous_conf is not None:
+            await asyncio.shield(restore_conf(app_name, previous_conf))
+        raise
+
+
+async def retune(stateful_set, config):
+    """Regenerate a tuned tenant's postgresql.conf for its new limits and mark the pod template to roll if it changed.
+
+    The ConfigMap is written before the StatefulSet, so the restarted pods mount the new file. Returns the file it
+    replaced, to be put back if the StatefulSet can't be updated, or None if the ConfigMap was left alone.
+    """
+    profile = (stateful_set.metadata.annotations or {}).get(WORKLOAD_PROFILE_ANNOTATION)
+    if profile not in pg_tuning.PROFILES:
+        return None
+    conf = pg_tuning.postgresql_conf(profile, config.memory_limit, config.cpu_limit)
+    template = stateful_set.spec.template.metadata
+    if conf is None or (template.annotations or {}).get(CONFIG_HASH_ANNOTATION) == pg_tuning.config_hash(conf):
+        return None
+    config_map = await kube.call(kube.core_v1.read_namespaced_config_map, name=f"{config.app_name}-config",
+                                 namespace=NAMESPACE)
+    previous_conf = (config_map.data or {}).get(pg_tuning.CONFIG_KEY)
+    await write_conf(config.app_name, conf)
+    template.annotations = {**(template.annotations or {}), CONFIG_HASH_ANNOTATION: pg_tuning.config_hash(conf)}
+    return previous_conf
+
+
+async def write_conf(app_name, conf):
+    await kube.call(kube.core_v1.patch_namespaced_config_map, name=f"{app_name}-config", namespace=NAMESPACE,
+                    body={"data": {pg_tuning.CONFIG_KEY: conf}}, _content_type="application/merge-patch+json")
+
+
+async def restore_conf(app_name, conf):
+    try:
+        await write_conf(app_name, conf)
+    except Exception:
+        logger.exception("restoring the postgresql.conf of %s failed", app_name)
+
+
+async def deploy(config):
+    """Update an existing tenant's resources or provision a new one; returns (created, timings).
+
+    Everything else about an existing tenant is kept, so a redeploy that would change it is refused with
+    ConfigConflict rather than reported as a success.
+    """
+    try:
+        stateful_set = await read_stateful_set(config.app_name)
+    except ApiException as e:
+        if e.status != 404:
+            raise
+        return True, await provision(config)
+    changes = provisioned_changes(stateful_set, config)
+    if changes:
+        raise ConfigConflict(f"{', '.join(changes)} of {config.app_name} can only be set when it is first deployed")
+    await update_resources(config, stateful_set=stateful_set)
+    return False, {}
@@ -0,0 +1,128 @@
+import os
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from kubernetes.aio.client.exceptions import ApiException
+from prometheus_client import Counter, Gauge, Histogram
+from status_cache import app_name_of_stateful_set
+import db
+import kube
+from metrics import KUBE_BUCKETS
+import health_store
+
+logger = logging.getLogger(__name__)
+
+HEALTH_PROBE_INTERVAL_SECONDS = float(os.getenv("HEALTH_PROBE_INTERVAL_SECONDS", "60"))
+HEALTH_PROBE_TIMEOUT_SECONDS = float(os.getenv("HEALTH_PROBE_TIMEOUT_SECONDS", "5"))
+# Also open a TCP connection to each tenant's Service, not just compare ready replicas
+HEALTH_PROBE_TCP = os.getenv("HEALTH_PROBE_TCP", "true").lower() == "true"
+
+HEALTH_PROBE_DURATION = Histogram("health_probe_cycle_seconds", "Duration of a full health probe cycle in seconds",
+                                  buckets=KUBE_BUCKETS)
+HEALTH_PROBE_RESULTS = Counter("health_probe_results_total", "Health probe outcomes", ["app_name", "outcome"])
+HEALTH_PROBE_UP = Gauge("health_probe_up", "1 if the last probe of the app succeeded", ["app_name"],
+                        multiprocess_mode="livemin")
+HEALTH_PROBE_WRITE_ERRORS = Counter("health_probe_write_errors_total", "Failed writes of probe results")
+
+
+def is_monitored(stateful_set):
+    return (stateful_set.spec.selector.match_labels or {}).get("monitor") == "true"
+
+
+class HealthProber:
+    """Probes every monitored tenant concurrently on a fixed interval and records the cycle in one upsert.
+
+    Every worker and replica runs a prober, but only the one holding the health_prober advisory lock probes, so
+    each cycle is counted once; the others take over if it goes away. Results are read back from the database.
+    """
+
+    def __init__(self, status_cache, interval=HEALTH_PROBE_INTERVAL_SECONDS):
+        self.status_cache = status_cache
+        self.interval = interval
+        self.lock = db.AdvisoryLock("health_prober")
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        await self.lock.release()
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("health probe cycle failed")
+            await asyncio.sleep(self.interval)
+
+    async def _monitored(self):
+        if self.status_cache.synced:
+            stateful_sets = [stateful_set for _, stateful_set, _ in self.status_cache.list_apps()]
+        else:
+            stateful_sets = (await kube.shared(kube.apps_v1.list_namespaced_stateful_set, namespace="default")).items
+        return [stateful_set for stateful_set in stateful_sets if is_monitored(stateful_set)]
+
+    async def run_once(self):
+        if not await self.lock.held():
+            return []
+        start = time.perf_counter()
+        try:
+            monitored = await self._monitored()
+        except (ApiException, TimeoutError) as e:
+            logger.warning("could not list monitored apps: %s", e)
+            return []
+        results = await asyncio.gather(*(self.probe(stateful_set) for stateful_set in monitored))
+        try:
+            await health_store.record_results(results)
+        except Exception:
+            HEALTH_PROBE_WRITE_ERRORS.inc()
+            logger.exception("could not record health probe results")
+        HEALTH_PROBE_DURATION.observe(time.perf_counter() - start)
+        return results
+
+    async def latest(self):
+        """The last outcome of every app probed within the last two cycles, by whichever process probed it."""
+        return await health_store.latest(datetime.now() - timedelta(seconds=2 * self.interval))
+
+    async def probe(self, stateful_set):
+        app_name = app_name_of_stateful_set(stateful_set.metadata.name)
+        replicas = stateful_set.spec.replicas
+        ready_replicas = stateful_set.status.ready_replicas if stateful_set.status else None
+        error = None
+        if replicas != (ready_replicas or 0):
+            error = f"{ready_replicas or 0}/{replicas} replicas ready"
+        elif HEALTH_PROBE_TCP:
+            error = await self._connect(app_name, stateful_set)
+
+        healthy = error is None
+        HEALTH_PROBE_RESULTS.labels(app_name=app_name, outcome="success" if healthy else "failure").inc()
+        HEALTH_PROBE_UP.labels(app_name=app_name).set(1 if healthy else 0)
+        created_at = stateful_set.metadata.creation_timestamp
+        return {
+            "app_name": app_name,
+            "healthy": healthy,
+            "error": error,
+            "replicas": replicas,
+            "ready_replicas": ready_replicas,
+            "created_at": created_at.replace(tzinfo=None) if created_at else None,
+        }
+
+    @staticmethod
+    async def _connect(app_name, stateful_set):
+        ports = stateful_set.spec.template.spec.containers[0].ports or []
+        if not ports:
+            return None
+        try:
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection(f"{app_name}-service", ports[0].container_port),
+                HEALTH_PROBE_TIMEOUT_SECONDS
+            )
+        except (OSError, TimeoutError) as e:
+            return f"connect failed: {e or type(e).__name__}"
+        writer.close()
+        return None
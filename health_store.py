@@ -0,0 +1,292 @@
+import os
+import asyncio
+import logging
+from datetime import datetime, timedelta
+import orjson
+from prometheus_client import Counter
+from cache import TTLCache
+import db
+
+HEALTH_EVENT_RETENTION_DAYS = int(os.getenv("HEALTH_EVENT_RETENTION_DAYS", "30"))
+# Daily partitions created ahead of time, so a write at midnight never lands on a missing range
+HEALTH_EVENT_PARTITIONS_AHEAD = 2
+HISTORY_WINDOWS = {"1h": timedelta(hours=1), "24h": timedelta(hours=24), "7d": timedelta(days=7)}
+# Rollup granularity, and so how closely the history windows follow the clock
+ROLLUP_BUCKET_MINUTES = 5
+HEALTH_CACHE_SIZE = int(os.getenv("HEALTH_CACHE_SIZE", "10000"))
+HEALTH_CACHE_TTL_SECONDS = float(os.getenv("HEALTH_CACHE_TTL_SECONDS", "30"))
+# Every process LISTENs here for the apps whose health rows another one wrote; an empty payload means all of them
+HEALTH_CHANNEL = "health_changed"
+# NOTIFY payloads must stay under 8000 bytes
+HEALTH_NOTIFY_MAX_BYTES = 7900
+# How often the listening connection is checked, and how long to wait before listening again once it's lost
+HEALTH_LISTEN_CHECK_SECONDS = 5
+
+logger = logging.getLogger(__name__)
+
+HEALTH_CACHE_REQUESTS = Counter("health_cache_requests_total", "Lookups of the /health/{app_name} cache", ["result"])
+
+# Created on the first write; the unique index is what ON CONFLICT (app_name) relies on, and tables created before
+# the upsert was introduced don't have it, and may have duplicate rows to merge first. health_event's daily partitions are added by maintain_partitions.
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS health (
+        id SERIAL PRIMARY KEY,
+        app_name VARCHAR,
+        failure_count INTEGER,
+        success_count INTEGER,
+        last_failure TIMESTAMP,
+        last_success TIMESTAMP,
+        created_at TIMESTAMP
+    );
+    ALTER TABLE health ADD COLUMN IF NOT EXISTS last_error VARCHAR;
+    DO $$
+    BEGIN
+        -- Before the upsert an app could get several rows, over which the unique index can't be built: fold each
+        -- app's rows into its first one, adding up the counts and keeping the latest outcomes
+        IF to_regclass('ix_health_app_name') IS NULL THEN
+            UPDATE health SET failure_count = merged.failure_count, success_count = merged.success_count,
+                              last_failure = merged.last_failure, last_success = merged.last_success,
+                              created_at = merged.created_at
+            FROM (
+                SELECT min(id) AS id, sum(failure_count) AS failure_count, sum(success_count) AS success_count,
+                       max(last_failure) AS last_failure, max(last_success) AS last_success,
+                       min(created_at) AS created_at
+                FROM health WHERE app_name IS NOT NULL GROUP BY app_name HAVING count(*) > 1
+            ) merged
+            WHERE health.id = merged.id;
+            DELETE FROM health WHERE app_name IS NOT NULL AND id NOT IN (
+                SELECT min(id) FROM health WHERE app_name IS NOT NULL GROUP BY app_name
+            );
+        END IF;
+    END $$;
+    CREATE UNIQUE INDEX IF NOT EXISTS ix_health_app_name ON health (app_name);
+    CREATE TABLE IF NOT EXISTS health_event (
+        id BIGINT GENERATED BY DEFAULT AS IDENTITY,
+        checked_at TIMESTAMP NOT NULL,
+        app_name VARCHAR NOT NULL,
+        healthy BOOLEAN NOT NULL,
+        error VARCHAR,
+        PRIMARY KEY (id, checked_at)
+    ) PARTITION BY RANGE (checked_at);
+    CREATE TABLE IF NOT EXISTS health_rollup (
+        app_name VARCHAR,
+        bucket TIMESTAMP,
+        success_count INTEGER NOT NULL DEFAULT 0,
+        failure_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (app_name, bucket)
+    );
+"""
+
+# Statement text is fixed (one row per array element), so each is prepared once per pooled connection
+SELECT_HEALTH = """
+    SELECT id, app_name, failure_count, success_count, last_failure, last_success, created_at
+    FROM health WHERE app_name = $1
+"""
+SELECT_LATEST = """
+    SELECT app_name, last_success, last_failure, last_error, created_at FROM health
+    WHERE greatest(last_success, last_failure) > $1
+    ORDER BY app_name
+"""
+UPSERT_HEALTH = """
+    INSERT INTO health (app_name, success_count, failure_count, last_success, last_failure, created_at, last_error)
+    SELECT * FROM unnest($1::text[], $2::int[], $3::int[], $4::timestamp[], $5::timestamp[], $6::timestamp[],
+                         $7::text[])
+    ON CONFLICT (app_name) DO UPDATE SET
+        success_count = health.success_count + excluded.success_count,
+        failure_count = health.failure_count + excluded.failure_count,
+        last_success = coalesce(excluded.last_success, health.last_success),
+        last_failure = coalesce(excluded.last_failure, health.last_failure),
+        last_error = excluded.last_error
+"""
+INSERT_EVENTS = """
+    INSERT INTO health_event (app_name, checked_at, healthy, error)
+    SELECT app_name, $2, healthy, error FROM unnest($1::text[], $3::bool[], $4::text[]) AS e(app_name, healthy, error)
+"""
+UPSERT_ROLLUP = """
+    INSERT INTO health_rollup (app_name, bucket, success_count, failure_count)
+    SELECT app_name, $2, success_count, failure_count
+    FROM unnest($1::text[], $3::int[], $4::int[]) AS r(app_name, success_count, failure_count)
+    ON CONFLICT (app_name, bucket) DO UPDATE SET
+        success_count = health_rollup.success_count + excluded.success_count,
+        failure_count = health_rollup.failure_count + excluded.failure_count
+"""
+SELECT_ROLLUP = """
+    SELECT bucket, success_count, failure_count FROM health_rollup
+    WHERE app_name = $1 AND bucket > $2 ORDER BY bucket
+"""
+SELECT_PARTITIONS = """
+    SELECT child.relname FROM pg_inherits
+    JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+    JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+    WHERE parent.relname = 'health_event'
+"""
+DELETE_ROLLUP = "DELETE FROM health_rollup WHERE bucket < $1"
+
+_maintained_on = None
+_listener = None
+
+
+health_cache = TTLCache(HEALTH_CACHE_SIZE, HEALTH_CACHE_TTL_SECONDS)
+
+
+def _on_health_changed(connection, pid, channel, payload):
+    if payload:
+        health_cache.invalidate(orjson.loads(payload))
+    else:
+        health_cache.clear()
+
+
+async def listen():
+    """Evict the health rows other processes write from health_cache, LISTENing on a master connection.
+
+    Notifications sent while the connection is down are lost, so the whole cache is dropped whenever it's (re)taken.
+    """
+    while True:
+        try:
+            async with db.master_pool.acquire() as connection:
+                await connection.add_listener(HEALTH_CHANNEL, _on_health_changed)
+                health_cache.clear()
+                try:
+                    while True:
+                        await asyncio.sleep(HEALTH_LISTEN_CHECK_SECONDS)
+                        await connection.fetchval("SELECT 1")
+                finally:
+                    if not connection.is_closed():
+                        await asyncio.shield(connection.remove_listener(HEALTH_CHANNEL, _on_health_changed))
+        except Exception as e:
+            logger.warning("not listening for health changes: %s", e)
+            health_cache.clear()
+            await asyncio.sleep(HEALTH_LISTEN_CHECK_SECONDS)
+
+
+def start_listener():
+    global _listener
+    _listener = asyncio.create_task(listen())
+
+
+async def stop_listener():
+    if _listener is not None:
+        _listener.cancel()
+        await asyncio.gather(_listener, return_exceptions=True)
+
+
+async def get_health(app_name):
+    """The health row of `app_name` as a dict, or None; served from health_cache when possible."""
+    hit, record = health_cache.get(app_name)
+    HEALTH_CACHE_REQUESTS.labels(result="hit" if hit else "miss").inc()
+    if hit:
+        return record
+    generation = health_cache.generation
+    async with db.read("get_health") as connection:
+        row = await connection.fetchrow(SELECT_HEALTH, app_name)
+    record = dict(row) if row else None
+    health_cache.put(app_name, record, generation)
+    return record
+
+
+async def latest(since):
+    """The last recorded probe outcome of every app probed since `since`."""
+    async with db.read("latest_health") as connection:
+        rows = await connection.fetch(SELECT_LATEST, since)
+    return [
+        {
+            "app_name": row["app_name"],
+            "healthy": row["last_failure"] is None or (row["last_success"] or datetime.min) > row["last_failure"],
+            "error": row["last_error"],
+            "checked_at": max(filter(None, (row["last_success"], row["last_failure"]))),
+            "created_at": row["created_at"],
+        }
+        for row in rows
+    ]
+
+
+def rollup_bucket(moment):
+    return moment.replace(minute=moment.minute - moment.minute % ROLLUP_BUCKET_MINUTES, second=0, microsecond=0)
+
+
+def partition_name(day):
+    return f"health_event_{day:%Y%m%d}"
+
+
+async def maintain_partitions(connection, today):
+    """Create the upcoming daily partitions of health_event and drop those past retention."""
+    for offset in range(HEALTH_EVENT_PARTITIONS_AHEAD + 1):
+        day = today + timedelta(days=offset)
+        await connection.execute(
+            f"CREATE TABLE IF NOT EXISTS {partition_name(day)} PARTITION OF health_event "
+            f"FOR VALUES FROM ('{day:%Y-%m-%d}') TO ('{day + timedelta(days=1):%Y-%m-%d}')"
+        )
+    cutoff = partition_name(today - timedelta(days=HEALTH_EVENT_RETENTION_DAYS))
+    for partition in await connection.fetch(SELECT_PARTITIONS):
+        # Names sort by date, so a string comparison finds the expired ones
+        if partition["relname"] < cutoff:
+            await connection.execute(f"DROP TABLE IF EXISTS {partition['relname']}")
+    await connection.execute(
+        DELETE_ROLLUP,
+        datetime.combine(today, datetime.min.time()) - timedelta(days=HEALTH_EVENT_RETENTION_DAYS)
+    )
+
+
+async def record_results(results):
+    """Append one probe cycle to health_event and fold it into the cumulative and rollup tables, in one transaction."""
+    global _maintained_on
+    if not results:
+        return
+    now = datetime.now()
+    bucket = rollup_bucket(now)
+    app_names = [result["app_name"] for result in results]
+    healthy = [result["healthy"] for result in results]
+    success_counts = [1 if ok else 0 for ok in healthy]
+    failure_counts = [0 if ok else 1 for ok in healthy]
+    await db.ensure_schema("health", SCHEMA)
+    async with db.write("record_results") as connection:
+        if _maintained_on != now.date():
+            await maintain_partitions(connection, now.date())
+        await connection.execute(
+            UPSERT_HEALTH, app_names, success_counts, failure_counts,
+            [now if ok else None for ok in healthy],
+            [None if ok else now for ok in healthy],
+            [result["created_at"] for result in results],
+            [result.get("error") for result in results]
+        )
+        await connection.execute(INSERT_EVENTS, app_names, now, healthy, [result.get("error") for result in results])
+        await connection.execute(UPSERT_ROLLUP, app_names, bucket, success_counts, failure_counts)
+        payload = orjson.dumps(app_names)
+        await connection.execute("SELECT pg_notify($1, $2)", HEALTH_CHANNEL,
+                                 payload.decode() if len(payload) <= HEALTH_NOTIFY_MAX_BYTES else "")
+    health_cache.invalidate(app_names)
+    _maintained_on = now.date()
+
+
+async def history(app_name):
+    """Availability of `app_name` over each of HISTORY_WINDOWS, summed from the rollups, and its hourly series.
+
+    A window ends now and is accurate to ROLLUP_BUCKET_MINUTES: the bucket its start falls in is counted whole.
+    """
+    now = datetime.now()
+    bucket_size = timedelta(minutes=ROLLUP_BUCKET_MINUTES)
+    async with db.read("history") as connection:
+        rows = await connection.fetch(SELECT_ROLLUP, app_name, now - max(HISTORY_WINDOWS.values()) - bucket_size)
+    if not rows:
+        return None
+    windows = {}
+    for name, window in HISTORY_WINDOWS.items():
+        in_window = [row for row in rows if row["bucket"] + bucket_size > now - window]
+        success = sum(row["success_count"] for row in in_window)
+        failure = sum(row["failure_count"] for row in in_window)
+        windows[name] = {
+            "success_count": success,
+            "failure_count": failure,
+            "availability": round(success / (success + failure), 4) if success + failure else None,
+        }
+    hourly = {}
+    for row in rows:
+        hour = row["bucket"].replace(minute=0)
+        totals = hourly.setdefault(hour, {"hour": hour, "success_count": 0, "failure_count": 0})
+        totals["success_count"] += row["success_count"]
+        totals["failure_count"] += row["failure_count"]
+    return {
+        "app_name": app_name,
+        "windows": windows,
+        "hourly": list(hourly.values()),
+    }
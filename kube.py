@@ -0,0 +1,147 @@
+import os
+import asyncio
+import threading
+import time
+import aiohttp
+from kubernetes.aio import client, config
+from kubernetes.aio.client.exceptions import ApiException
+from kubernetes.aio.client.rest import RESTClientObject
+from prometheus_client import Counter, Histogram
+from cluster import in_cluster
+from metrics import KUBE_BUCKETS
+
+KUBE_TIMEOUT_SECONDS = float(os.getenv("KUBE_TIMEOUT_SECONDS", "10"))
+KUBE_THROTTLE_RETRIES = int(os.getenv("KUBE_THROTTLE_RETRIES", "3"))
+KUBE_MAX_RETRY_AFTER_SECONDS = 10
+# Upper bound on concurrent connections to the API server, shared by every caller in the process
+KUBE_POOL_MAXSIZE = int(os.getenv("KUBE_POOL_MAXSIZE", "64"))
+KUBE_KEEPALIVE_SECONDS = float(os.getenv("KUBE_KEEPALIVE_SECONDS", "60"))
+
+KUBE_REQUEST_LATENCY = Histogram("kube_request_duration_seconds", "Latency of Kubernetes API requests in seconds",
+                                 ["verb", "resource"], buckets=KUBE_BUCKETS)
+KUBE_REQUEST_ERRORS = Counter("kube_request_errors_total", "Failed Kubernetes API requests",
+                              ["verb", "resource", "code"])
+KUBE_SHARED_REQUESTS = Counter("kube_shared_requests_total",
+                               "Coalescable Kubernetes reads, by whether they made the call or joined one in flight",
+                               ["method", "outcome"])
+
+# Module attributes built on first access, see __getattr__
+API_GROUPS = {
+    "apps_v1": "AppsV1Api",
+    "core_v1": "CoreV1Api",
+    "networking_v1": "NetworkingV1Api",
+    "version_api": "VersionApi",
+    "custom_objects": "CustomObjectsApi",
+}
+
+api_client = None
+_apis = {}
+_in_flight = {}
+
+
+class KeepAliveRESTClient(RESTClientObject):
+    """Keeps idle API server connections open longer and caches DNS, so bursts reuse warm connections."""
+
+    def _create_connector(self):
+        return aiohttp.TCPConnector(limit=self.maxsize, ssl=self.ssl_context, keepalive_timeout=KUBE_KEEPALIVE_SECONDS,
+                                    ttl_dns_cache=300)
+
+
+async def connect():
+    global api_client
+    if in_cluster():
+        config.load_incluster_config()
+    else:
+        await config.load_kube_config()
+    configuration = client.Configuration.get_default_copy()
+    configuration.connection_pool_maxsize = KUBE_POOL_MAXSIZE
+    api_client = client.ApiClient(configuration)
+    api_client.rest_client = KeepAliveRESTClient(configuration)
+    _apis.clear()
+    # Building the API classes (and the models they import) is most of our startup time, so it happens off the
+    # request path; anything that needs one before then builds it itself
+    threading.Thread(target=warm, name="kube-warm", daemon=True).start()
+
+
+def warm():
+    for name in API_GROUPS:
+        __getattr__(name)
+
+
+def __getattr__(name):
+    if name not in API_GROUPS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    api = _apis.get(name)
+    if api is None:
+        if api_client is None:
+            raise RuntimeError(f"kube.{name} used before kube.connect()")
+        api = _apis[name] = getattr(client, API_GROUPS[name])(api_client)
+    return api
+
+
+async def close():
+    if api_client is not None:
+        await api_client.close()
+
+
+def retry_after(error, default):
+    value = (error.headers or {}).get("Retry-After")
+    if value and value.isdigit():
+        return min(int(value), KUBE_MAX_RETRY_AFTER_SECONDS)
+    return default
+
+
+def verb_and_resource(method):
+    # read_namespaced_stateful_set -> ("read", "stateful_set")
+    verb, _, resource = method.__name__.partition("_")
+    return verb, resource.removeprefix("namespaced_")
+
+
+async def call(method, *args, timeout=None, **kwargs):
+    """Await a Kubernetes API method, raising TimeoutError if it takes longer than `timeout` seconds.
+
+    429s from API priority and fairness are retried after their Retry-After, up to KUBE_THROTTLE_RETRIES times.
+    Every attempt is timed and failures are counted by verb, resource and status code.
+    """
+    timeout = timeout or KUBE_TIMEOUT_SECONDS
+    verb, resource = verb_and_resource(method)
+    for attempt in range(KUBE_THROTTLE_RETRIES + 1):
+        start = time.perf_counter()
+        try:
+            return await asyncio.wait_for(method(*args, _request_timeout=timeout, **kwargs), timeout)
+        except ApiException as e:
+            KUBE_REQUEST_ERRORS.labels(verb=verb, resource=resource, code=e.status).inc()
+            if e.status != 429 or attempt == KUBE_THROTTLE_RETRIES:
+                raise
+            delay = retry_after(e, 2 ** attempt)
+        except TimeoutError:
+            KUBE_REQUEST_ERRORS.labels(verb=verb, resource=resource, code="timeout").inc()
+            raise
+        finally:
+            KUBE_REQUEST_LATENCY.labels(verb=verb, resource=resource).observe(time.perf_counter() - start)
+        await asyncio.sleep(delay)
+
+
+async def shared(method, *args, timeout=None, **kwargs):
+    """Like call(), but concurrent reads with identical arguments share one request.
+
+    Every caller gets the same response object, so it must be treated as read-only.
+    """
+    key = (method.__qualname__, args, tuple(sorted(kwargs.items())))
+    future = _in_flight.get(key)
+    if future is None:
+        KUBE_SHARED_REQUESTS.labels(method=method.__name__, outcome="called").inc()
+        future = asyncio.ensure_future(call(method, *args, timeout=timeout, **kwargs))
+        _in_flight[key] = future
+        future.add_done_callback(lambda done: _forget(key, done))
+    else:
+        KUBE_SHARED_REQUESTS.labels(method=method.__name__, outcome="joined").inc()
+    # One caller going away (e.g. a client disconnect) must not cancel the request for the others
+    return await asyncio.shield(future)
+
+
+def _forget(key, future):
+    _in_flight.pop(key, None)
+    if not future.cancelled():
+        # Mark the exception retrieved in case every caller was cancelled
+        future.exception()
@@ -1,32 +1,93 @@
-import os
-from kubernetes import client, config
-from kubernetes.client.rest import ApiException
-from fastapi import FastAPI, HTTPException, Depends, Request, Response
-from pydantic import BaseModel
-from datetime import datetime
-import asyncpg
-from sqlalchemy import create_engine
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session
-from models import Health
-from db import engine, connect_to_db
-from prometheus_client import Counter, Histogram, generate_latest
+import startup
+from kubernetes.aio.client.exceptions import ApiException
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field, model_validator
+from typing import List, Literal, Optional
+import orjson
+import db
+from db import open_pools, close_pools
+from prometheus_client import Counter, Histogram, CONTENT_TYPE_LATEST
+from metrics import HTTP_BUCKETS, Exposition, mark_process_dead
+from contextlib import asynccontextmanager
+from status_cache import StatusCache, app_label_of_pod, app_label_of_stateful_set
+from status_snapshots import StatusSnapshots, AppStatus, Snapshot, app_status
+from status_feed import StatusFeed
+import kube
+import deploy
+import asyncio
+from operations import OperationQueue
+from health_prober import HealthProber
+from dependency_checker import DependencyChecker
+from rightsizing import Rightsizer
+from profiling import Profiler, PROFILE_HEADER, verify
+import health_store
+import pgbouncer
+import pg_tuning
 import time
 
 
-app = FastAPI()
-# Load kube config
-config.load_kube_config()
-
-# Create a client
-apps_v1 = client.AppsV1Api()
-core_v1 = client.CoreV1Api()
+# Watch-fed view of StatefulSets and Pods used to answer /status without calling the API server
+status_cache = StatusCache()
+# Encoded, ETagged /status responses built from the cache and reused until it changes
+status_snapshots = StatusSnapshots(status_cache)
+# Per-app status deltas from the cache, fanned out to /status/stream clients
+status_feed = StatusFeed(status_cache)
+
+# Rendered /metrics output, merged across workers when PROMETHEUS_MULTIPROC_DIR is set
+exposition = Exposition()
+
+# Opt-in sampling of individual requests, see /debug/profiles
+profiler = Profiler()
+
+# Probes every monitored app concurrently in the background and records the results
+health_prober = HealthProber(status_cache)
+
+# Samples tenant CPU and memory usage and recommends (or, with RIGHTSIZING_MODE=apply, submits) new resources
+rightsizer = Rightsizer(status_cache, submit=lambda app_name, resources: submit_rightsizing(app_name, resources))
+
+# Database and Kubernetes API reachability, checked in the background and read by the probe endpoints
+dependency_checker = DependencyChecker()
+
+POD_PAGE_SIZE = 500
+STATUS_STREAM_PAGE_SIZE = 100
+# Apps per `app in (...)` pod selector, keeping request URLs short
+POD_SELECTOR_BATCH = 50
+# Not counted as the first request served
+PROBE_ROUTES = {"/ready", "/healthz", "/start", "/metrics"}
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await kube.connect()
+    await open_pools()
+    health_store.start_listener()
+    status_cache.start()
+    status_feed.start()
+    operation_queue.start()
+    health_prober.start()
+    dependency_checker.start()
+    rightsizer.start()
+    startup.milestone("started")
+    yield
+    await rightsizer.stop()
+    await dependency_checker.stop()
+    await health_prober.stop()
+    await operation_queue.stop()
+    status_feed.stop()
+    await status_cache.stop()
+    await health_store.stop_listener()
+    await close_pools()
+    await kube.close()
+    mark_process_dead()
+
+
+app = FastAPI(lifespan=lifespan)
 
 REQUEST_COUNT = Counter("request_count", "Total number of requests")
 FAILED_REQUEST_COUNT = Counter("failed_request_count", "Total number of failed requests")
-REQUEST_LATENCY = Histogram("request_latency_seconds", "Latency of HTTP requests in seconds")
-DB_ERROR_COUNT = Counter("db_error_count", "Total number of database errors")
-DB_RESPONSE_LATENCY = Histogram("db_response_latency_seconds", "Latency of database responses in seconds")
+REQUEST_LATENCY = Histogram("request_latency_seconds", "Latency of HTTP requests in seconds",
+                            ["route", "method", "status"], buckets=HTTP_BUCKETS)
 
 class ApplicationConfig(BaseModel):
     app_name: str
@@ -44,6 +105,29 @@ class ApplicationConfig(BaseModel):
     cpu_limit: str
     memory_request: str
     memory_limit: str
+    # Optional PgBouncer sidecar, reachable on the tenant Service at pgbouncer_port
+    pgbouncer: bool = False
+    pgbouncer_pool_mode: Literal["session", "transaction", "statement"] = "transaction"
+    pgbouncer_pool_size: int = Field(20, ge=1)
+    pgbouncer_max_client_conn: int = Field(1000, ge=1)
+    pgbouncer_port: int = 6432
+    # Generates a postgresql.conf sized to the memory and CPU limits; None keeps the image's default config
+    workload_profile: Optional[Literal["oltp", "mixed", "analytics"]] = None
+
+    @model_validator(mode="after")
+    def check_pgbouncer_port(self):
+        # Both ports are published on the one tenant Service, which can't list a port twice
+        if self.pgbouncer and self.pgbouncer_port == self.service_port:
+            raise ValueError("pgbouncer_port must differ from service_port")
+        return self
+
+    @model_validator(mode="after")
+    def check_workload_profile(self):
+        # Tuning is sized from the limits, so without readable ones the tenant would silently run untuned
+        if self.workload_profile and (pg_tuning.tune(self.workload_profile, self.memory_limit, self.cpu_limit) is None
+                                      or pg_tuning.parse_quantity(self.cpu_limit) is None):
+            raise ValueError("workload_profile needs a memory_limit and cpu_limit that can be parsed")
+        return self
 
 
 class ResourceUpdateConfig(BaseModel):
@@ -54,241 +138,154 @@ class ResourceUpdateConfig(BaseModel):
     memory_limit: str
 
 
-@app.post("/deploy-application")
-def deploy_postgresql(config: ApplicationConfig):
-    app_name = config.app_name
-    replicas = config.replicas
-    user = config.user
-    password = config.password
-    db_name = config.db_name
-    image_address = config.image_address
-    image_tag = config.image_tag
-    domain_address = config.domain_address
-    service_port = config.service_port
-    external_access = config.external_access
-    monitor = config.monitor
-    cpu_request = config.cpu_request
-    cpu_limit = config.cpu_limit
-    memory_request = config.memory_request
-    memory_limit = config.memory_limit
-
-    api_instance = client.CoreV1Api()
-    apps_v1_api = client.AppsV1Api()
-    networking_v1_api = client.NetworkingV1Api()
+# Deploy and update requests are queued here, in Postgres, and run by a worker pool; callers poll /operations/{id}
+operation_queue = OperationQueue({"deploy": ApplicationConfig, "update": ResourceUpdateConfig,
+                                  "rightsize": ResourceUpdateConfig})
 
-    try:
-        stateful_set = apps_v1_api.read_namespaced_stateful_set(name=f"{app_name}-statefulset", namespace="default")
-        stateful_set.spec.template.spec.containers[0].resources = client.V1ResourceRequirements(
-            requests={"cpu": cpu_request, "memory": memory_request},
-            limits={"cpu": cpu_limit, "memory": memory_limit}
-        )
-        apps_v1_api.replace_namespaced_stateful_set(name=f"{app_name}-statefulset", namespace="default",
-                                                    body=stateful_set)
-        return {"message": f"Resources for {app_name} updated successfully"}
-    except client.exceptions.ApiException as e:
-        if e.status == 404:
 
-            secret = client.V1Secret(
-                metadata=client.V1ObjectMeta(name=f"{app_name}-secret"),
-                type="Opaque",
-                string_data={
-                    "DB_USER": user,
-                    "DB_PASSWORD": password,
-                    "DB_NAME": db_name,
-                }
-            )
-
-            config_map = client.V1ConfigMap(
-                metadata=client.V1ObjectMeta(name=f"{app_name}-config"),
-                data={
-                    "DB_USER": user,
-                    "DB_PASSWORD": password,
-                    "DB_NAME": db_name,
-                }
-            )
-
-            stateful_set = client.V1StatefulSet(
-                metadata=client.V1ObjectMeta(name=f"{app_name}-statefulset"),
-                spec=client.V1StatefulSetSpec(
-                    replicas=replicas,
-                    selector=client.V1LabelSelector(
-                        match_labels={"app": app_name,
-                                      'monitor': 'true' if monitor else 'false'}
-                    ),
-                    service_name=f"{app_name}-service",
-                    template=client.V1PodTemplateSpec(
-                        metadata=client.V1ObjectMeta(labels={"app": app_name,
-                                                             'monitor': 'true' if monitor else 'false'}),
-                        spec=client.V1PodSpec(containers=[
-                            client.V1Container(
-                                name=f"{app_name}-container",
-                                image=f"{image_address}:{image_tag}",
-                                env=[
-                                    client.V1EnvVar(
-                                        name="DB_USER",
-                                        value_from=client.V1EnvVarSource(
-                                            secret_key_ref=client.V1SecretKeySelector(
-                                                name=f"{app_name}-secret",
-                                                key="DB_USER"
-                                            )
-                                        )
-                                    ),
-                                    client.V1EnvVar(
-                                        name="POSTGRES_PASSWORD",
-                                        value_from=client.V1EnvVarSource(
-                                            secret_key_ref=client.V1SecretKeySelector(
-                                                name=f"{app_name}-secret",
-                                                key="DB_PASSWORD"
-                                            )
-                                        )
-                                    ),
-                                    client.V1EnvVar(
-                                        name="DB_NAME",
-                                        value_from=client.V1EnvVarSource(
-                                            secret_key_ref=client.V1SecretKeySelector(
-                                                name=f"{app_name}-secret",
-                                                key="DB_NAME"
-                                            )
-                                        )
-                                    )
-                                ],
-                                ports=[client.V1ContainerPort(container_port=service_port)]
-                            )
-                        ])
-                    )
-                )
-            )
-
-            service = client.V1Service(
-                metadata=client.V1ObjectMeta(name=f"{app_name}-service"),
-                spec=client.V1ServiceSpec(
-                    selector={"app": app_name},
-                    ports=[client.V1ServicePort(port=service_port, target_port=service_port)],
-                    type="LoadBalancer" if external_access else "ClusterIP"
-                )
-            )
-            ingress = client.V1Ingress(
-                metadata=client.V1ObjectMeta(name=f"{app_name}-ingress"),
-                spec=client.V1IngressSpec(
-                    rules=[
-                        client.V1IngressRule(
-                            host=domain_address,
-                            http=client.V1HTTPIngressRuleValue(
-                                paths=[
-                                    client.V1HTTPIngressPath(
-                                        path="/",
-                                        path_type="Prefix",
-                                        backend=client.V1IngressBackend(
-                                            service=client.V1IngressServiceBackend(
-                                                name=f"{app_name}-service",
-                                                port=client.V1ServiceBackendPort(number=service_port)
-                                            )
-                                        )
-                                    )
-                                ]
-                            )
-                        )
-                    ]
-                )
-            )
-
-
-            try:
-                api_instance.create_namespaced_secret(
-                    namespace="default",
-                    body=secret
-                )
-
-                api_instance.create_namespaced_config_map(
-                    namespace="default",
-                    body=config_map
-                )
-
-                apps_v1_api.create_namespaced_stateful_set(
-                    namespace="default",
-                    body=stateful_set
-                )
-
-                api_instance.create_namespaced_service(
-                    namespace="default",
-                    body=service
-                )
-                if external_access:
-                    networking_v1_api.create_namespaced_ingress(
-                        namespace="default",
-                        body=ingress
-                    )
-            except client.exceptions.ApiException as e:
-                raise HTTPException(status_code=400, detail=str(e))
-
-    return {"message": f"Application deployment for {app_name} created successfully"}
-
-
-@app.post("/update-resources")
-def update_resources(config: ResourceUpdateConfig):
-    app_name = config.app_name
-    cpu_request = config.cpu_request
-    cpu_limit = config.cpu_limit
-    memory_request = config.memory_request
-    memory_limit = config.memory_limit
-
-    apps_v1_api = client.AppsV1Api()
+async def submit_rightsizing(app_name, resources):
+    return await operation_queue.submit("rightsize", ResourceUpdateConfig(app_name=app_name, **resources))
+
+
+async def submit_operations(kind, configs):
     try:
-        stateful_set = apps_v1_api.read_namespaced_stateful_set(name=f"{app_name}-statefulset", namespace="default")
+        return await operation_queue.submit_many(kind, configs)
+    except asyncio.QueueFull:
+        raise HTTPException(status_code=503, detail="Operation queue is full", headers={"Retry-After": "5"})
+    except db.UNAVAILABLE as e:
+        # Operations are queued in Postgres, so nothing can be accepted while it is down
+        raise HTTPException(status_code=503, detail=f"Operation queue unavailable: {e}", headers={"Retry-After": "5"})
 
-        stateful_set.spec.template.spec.containers[0].resources = client.V1ResourceRequirements(
-            requests={"cpu": cpu_request, "memory": memory_request},
-            limits={"cpu": cpu_limit, "memory": memory_limit}
-        )
 
-        apps_v1_api.replace_namespaced_stateful_set(name=f"{app_name}-statefulset", namespace="default",
-                                                    body=stateful_set)
+def accepted(operation):
+    return {"operation_id": operation.id, "state": operation.state, "status_url": f"/operations/{operation.id}"}
 
-    except client.exceptions.ApiException as e:
-        if e.status == 404:
-            raise HTTPException(status_code=404, detail=f"StatefulSet for {app_name} not found")
+
+async def submit_operation(kind, config):
+    operations = await submit_operations(kind, [config])
+    return accepted(operations[0])
+
+
+@app.post("/deploy-application", status_code=202)
+async def deploy_postgresql(config: ApplicationConfig):
+    return await submit_operation("deploy", config)
+
+
+@app.post("/deploy-applications", status_code=202)
+async def deploy_postgresql_bulk(configs: List[ApplicationConfig]):
+    """Queue a deploy operation per tenant, all or none, and return their IDs in request order.
+
+    The operation workers bound how many tenants are provisioned at once, and the whole batch is refused with 503
+    unless the queue has room for it.
+    """
+    unique = {}
+    skipped = set()
+    for index, config in enumerate(configs):
+        if config.app_name in unique:
+            skipped.add(index)
         else:
-            raise HTTPException(status_code=400, detail=str(e))
+            unique[config.app_name] = config
+    operations = iter(await submit_operations("deploy", list(unique.values())))
+    return {"results": [
+        {"app_name": config.app_name, "state": "skipped", "error": "Duplicate app_name in batch"}
+        if index in skipped else {"app_name": config.app_name, **accepted(next(operations))}
+        for index, config in enumerate(configs)
+    ]}
+
 
-    return {"message": f"Resources for {app_name} updated successfully"}
+@app.post("/update-resources", status_code=202)
+async def update_resources(config: ResourceUpdateConfig):
+    return await submit_operation("update", config)
 
 
-@app.get("/status/{app_name}")
-def get_app_status(app_name):
+@app.get("/rightsizing")
+async def list_rightsizing():
+    return rightsizer.recommendations()
 
+
+@app.get("/rightsizing/{app_name}")
+async def get_rightsizing(app_name):
+    recommendation = rightsizer.recommendation(app_name)
+    if recommendation is None:
+        raise HTTPException(status_code=404, detail=f"No usage samples for {app_name}")
+    return recommendation
+
+
+@app.get("/operations/{operation_id}")
+async def get_operation(operation_id: str):
     try:
-        # Get the deployment
-        deployment = apps_v1.read_namespaced_stateful_set(name=f'{app_name}-statefulset', namespace="default")
+        operation = await operation_queue.get(operation_id)
+    except db.UNAVAILABLE as e:
+        raise HTTPException(status_code=503, detail=f"Operation queue unavailable: {e}", headers={"Retry-After": "5"})
+    if operation is None:
+        raise HTTPException(status_code=404, detail=f"Operation {operation_id} not found")
+    return operation.to_dict()
+
+
+async def list_pods_by_app():
+    # One paged list of every app-labelled pod instead of a list call per StatefulSet
+    pods_by_app = {}
+    _continue = None
+    while True:
+        pod_list = await kube.shared(kube.core_v1.list_namespaced_pod, namespace="default", label_selector="app",
+                                     limit=POD_PAGE_SIZE, _continue=_continue)
+        for pod in pod_list.items:
+            pods_by_app.setdefault(app_label_of_pod(pod), []).append(pod)
+        _continue = pod_list.metadata.var_continue
+        if not _continue:
+            return pods_by_app
+
+
+def snapshot_response(request: Request, snapshot: Snapshot):
+    headers = {"ETag": snapshot.etag}
+    if snapshot.matches(request.headers.get("if-none-match")):
+        return Response(status_code=304, headers=headers)
+    return Response(snapshot.body, media_type="application/json", headers=headers)
+
 
-        # Extract deployment information
-        deployment_name = deployment.metadata.name
-        replicas = deployment.spec.replicas
-        ready_replicas = deployment.status.ready_replicas
+@app.get("/status/stream")
+async def stream_status_changes():
+    """Server-Sent Events: a `snapshot` event with every app's status, then an `app` event whenever one changes.
+
+    An `app` event carries the app's full new status, or null once it's gone. Clients that fall too far behind are
+    sent a fresh `snapshot` in place of the events they missed.
+    """
+    if status_feed.full:
+        raise HTTPException(status_code=503, detail="Too many status stream subscribers")
+    return StreamingResponse(status_feed.events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.get("/status/{app_name}", responses={200: {"model": AppStatus}})
+async def get_app_status(app_name, request: Request):
+    if status_cache.synced:
+        snapshot = status_snapshots.app(app_name)
+        if snapshot is None:
+            return {"error": "Deployment not found"}
+        found = status_cache.get_app(app_name)
+        pooler_port = pgbouncer.port_of(found[0]) if found else None
+        if pooler_port is None:
+            return snapshot_response(request, snapshot)
+        # Pooler stats change by the second, so pooled apps are answered fresh rather than from the snapshot
+        return {**orjson.loads(snapshot.body), "Pooler": await pgbouncer.stats(app_name, pooler_port)}
+
+    try:
+        # Get the deployment
+        deployment = await kube.shared(kube.apps_v1.read_namespaced_stateful_set, name=f'{app_name}-statefulset',
+                                       namespace="default")
 
         # Get pods related to the deployment
-        pod_list = core_v1.list_namespaced_pod(namespace="default", label_selector=f"app={app_name}")
-        # Extract pod information
-        pod_statuses = []
-        for pod in pod_list.items:
-            pod_status = {
-                "Name": pod.metadata.name,
-                "Phase": pod.status.phase,
-                "HostIP": pod.status.host_ip,
-                "PodIP": pod.status.pod_ip,
-                "StartTime": pod.status.start_time.strftime('%Y-%m-%d %H:%M:%S') if pod.status.start_time else None
-            }
-            pod_statuses.append(pod_status)
-
-        # Build the response
-        response = {
-            "DeploymentName": deployment_name,
-            "Replicas": replicas,
-            "ReadyReplicas": ready_replicas,
-            "PodStatuses": pod_statuses
-        }
+        pod_list = await kube.shared(kube.core_v1.list_namespaced_pod, namespace="default",
+                                     label_selector=f"app={app_name}")
 
-        return response
+        status = app_status(deployment.metadata.name, deployment, pod_list.items)
+        pooler_port = pgbouncer.port_of(deployment)
+        if pooler_port is not None:
+            status["Pooler"] = await pgbouncer.stats(app_name, pooler_port)
+        return status
 
+    except TimeoutError:
+        return {"error": "Timed out waiting for the Kubernetes API"}
     except ApiException as e:
         if e.status == 404:
             return {"error": "Deployment not found"}
@@ -296,173 +293,205 @@ def get_app_status(app_name):
             return {"error": str(e)}
 
 
-@app.get("/status/")
-def get_all_status():
+async def list_pods_for_apps(app_names):
+    batches = [app_names[i:i + POD_SELECTOR_BATCH] for i in range(0, len(app_names), POD_SELECTOR_BATCH)]
+    pod_lists = await asyncio.gather(*(
+        kube.shared(kube.core_v1.list_namespaced_pod, namespace="default",
+                    label_selector=f"app in ({','.join(batch)})")
+        for batch in batches
+    ))
+    pods_by_app = {}
+    for pod_list in pod_lists:
+        for pod in pod_list.items:
+            pods_by_app.setdefault(app_label_of_pod(pod), []).append(pod)
+    return pods_by_app
+
+
+async def status_page(limit, _continue=None):
+    # One page of StatefulSets, passing the API server's continue token straight through
+    deployments = await kube.shared(kube.apps_v1.list_namespaced_stateful_set, namespace="default", limit=limit,
+                                    _continue=_continue)
+    names = [app_label_of_stateful_set(deployment) for deployment in deployments.items]
+    pods_by_app = await list_pods_for_apps(names) if names else {}
+    statuses = [app_status(name, deployment, pods_by_app.get(name, []))
+                for name, deployment in zip(names, deployments.items)]
+    return statuses, deployments.metadata.var_continue
+
+
+async def stream_status():
+    if status_cache.synced:
+        for line in status_snapshots.stream():
+            yield line
+        return
+
+    _continue = None
+    while True:
+        try:
+            statuses, _continue = await status_page(STATUS_STREAM_PAGE_SIZE, _continue)
+        except TimeoutError:
+            yield orjson.dumps({"error": "Timed out waiting for the Kubernetes API"}) + b"\n"
+            return
+        except ApiException as e:
+            yield orjson.dumps({"error": str(e)}) + b"\n"
+            return
+        for status in statuses:
+            yield orjson.dumps(status) + b"\n"
+        if not _continue:
+            return
+
+
+@app.get("/status/", responses={200: {"model": List[AppStatus]}})
+async def get_all_status(request: Request,
+                         limit: Optional[int] = Query(None, ge=1),
+                         continue_: Optional[str] = Query(None, alias="continue"),
+                         stream: bool = False):
+    if stream:
+        return StreamingResponse(stream_status(), media_type="application/x-ndjson")
+
+    if limit is not None or continue_ is not None:
+        try:
+            statuses, _continue = await status_page(limit, continue_)
+        except TimeoutError:
+            return {"error": "Timed out waiting for the Kubernetes API"}
+        except ApiException as e:
+            if e.status == 410:
+                raise HTTPException(status_code=410, detail="Continue token expired, restart the listing")
+            return {"error": str(e)}
+        return {"items": statuses, "continue": _continue}
+
+    if status_cache.synced:
+        return snapshot_response(request, status_snapshots.all())
+
     try:
         # Get all deployments
-        deployments = apps_v1.list_namespaced_stateful_set(namespace="default")
+        deployments = await kube.shared(kube.apps_v1.list_namespaced_stateful_set, namespace="default")
 
-        all_apps_status = []
+        pods_by_app = await list_pods_by_app()
 
+        all_apps_status = []
         for deployment in deployments.items:
-            # Extract deployment information
-            deployment_name = deployment.metadata.name.split('-')
-            deployment_name.pop(-1)
-            name = ''
-            for item in deployment_name:
-                name += item + '-'
-            deployment_name = name[:-1]
-            print(deployment_name)
-            replicas = deployment.spec.replicas
-            ready_replicas = deployment.status.ready_replicas
-
-            # Get pods related to the deployment
-            pod_list = core_v1.list_namespaced_pod(namespace="default", label_selector=f"app={deployment_name}")
-
-            # Extract pod information
-            pod_statuses = []
-            for pod in pod_list.items:
-                pod_status = {
-                    "Name": pod.metadata.name,
-                    "Phase": pod.status.phase,
-                    "HostIP": pod.status.host_ip,
-                    "PodIP": pod.status.pod_ip,
-                    "StartTime": pod.status.start_time.strftime('%Y-%m-%d %H:%M:%S') if pod.status.start_time else None
-                }
-                pod_statuses.append(pod_status)
-
-            # Build the deployment status
-            deployment_status = {
-                "DeploymentName": deployment_name,
-                "Replicas": replicas,
-                "ReadyReplicas": ready_replicas,
-                "PodStatuses": pod_statuses
-            }
-
-            all_apps_status.append(deployment_status)
+            app_name = app_label_of_stateful_set(deployment)
+            all_apps_status.append(app_status(app_name, deployment, pods_by_app.get(app_name, [])))
 
         return all_apps_status
 
+    except TimeoutError:
+        return {"error": "Timed out waiting for the Kubernetes API"}
     except ApiException as e:
         return {"error": str(e)}
 
 
 @app.get('/health')
-def get_health():
-    deployments = apps_v1.list_namespaced_stateful_set(namespace="default")
-    monitored = []
-    for dp in deployments.items:
-        labels = dp.spec.selector.match_labels
-        try:
-            should_monitor = labels['monitor']
-            if should_monitor:
-                monitored.append(dp)
-        except Exception as e:
-            continue
-    for deployment in monitored:
-        deployment_name = deployment.metadata.name.split('-')
-        deployment_name.pop(-1)
-        name = ''
-        for item in deployment_name:
-            name += item + '-'
-        app_name = name[:-1]
-        created_at = deployment.status.start_time.strftime('%Y-%m-%d %H:%M:%S')
-
-        replicas = deployment.spec.replicas
-        ready_replicas = deployment.status.ready_replicas
-        if replicas != ready_replicas:
-            raise HTTPException(400, detail=f"{app_name},{created_at}")
-
-        deployment_status = {
-            "app_name": app_name,
-            "created_at": created_at,
-        }
-        return deployment_status
+async def get_health():
+    """Latest probe result for every monitored app, as recorded by the prober's recent cycles."""
+    results = await health_prober.latest()
+    return {
+        "checked_at": max(result["checked_at"] for result in results).isoformat() if results else None,
+        "apps": [
+            {**result, "checked_at": result["checked_at"].isoformat(),
+             "created_at": result["created_at"].strftime('%Y-%m-%d %H:%M:%S') if result["created_at"] else None}
+            for result in results
+        ]
+    }
 
 
 @app.get('/health/{app_name}')
-def get_health_status(app_name, db: Session = Depends(connect_to_db)):
-    record = db.query(Health).filter(Health.app_name == app_name).first()
+async def get_health_status(app_name):
+    record = await health_store.get_health(app_name)
     if record:
         return record
     else:
         raise HTTPException(status_code=404, detail=f"Application {app_name} not found")
 
 
-is_database_connected = True
-is_service_ready = True
-is_service_healthy = True
-is_service_started = True
+@app.get('/health/{app_name}/history')
+async def get_health_history(app_name):
+    history = await health_store.history(app_name)
+    if history is None:
+        raise HTTPException(status_code=404, detail=f"No health history for {app_name}")
+    return history
 
 
 @app.get("/ready")
-def readiness_probe():
-
-    if is_service_ready and is_database_connected:
-        return {"status": "ready"}
-    else:
-        raise HTTPException(status_code=503, detail="Service not ready")
+async def readiness_probe():
+    if dependency_checker.ready:
+        startup.milestone("ready")
+        return {"status": "ready", "checks": dependency_checker.results}
+    raise HTTPException(status_code=503, detail={"status": "not ready", "checks": dependency_checker.results})
 
 
 @app.get("/healthz")
-def liveness_probe():
-
-    if is_service_healthy:
+async def liveness_probe():
+    if dependency_checker.alive:
         return {"status": "healthy"}
-    else:
-        raise HTTPException(status_code=500, detail="Service not healthy")
+    raise HTTPException(status_code=500, detail="Service not healthy")
 
 
 @app.get("/start")
-def startup_probe():
-
-    if is_service_started:
+async def startup_probe():
+    if dependency_checker.started:
         return {"status": "started"}
-    else:
-        raise HTTPException(status_code=500, detail="Service not started")
+    raise HTTPException(status_code=500, detail="Service not started")
 
 
 @app.middleware("http")
 async def metrics_middleware(request: Request, call_next):
     REQUEST_COUNT.inc()
-    start_time = time.time()
+    start_time = time.perf_counter()
+    status = 500
+    profile = profiler.begin(request)
     try:
         response = await call_next(request)
-        if response.status_code >= 400:
-            FAILED_REQUEST_COUNT.inc()
+        status = response.status_code
         return response
-    except Exception as e:
-        FAILED_REQUEST_COUNT.inc()
-        raise e
     finally:
-        duration = time.time() - start_time
-        REQUEST_LATENCY.observe(duration)
+        if status >= 400:
+            FAILED_REQUEST_COUNT.inc()
+        # The matched route's template, not the raw path, so /status/{app_name} stays one series
+        route = request.scope.get("route")
+        route = route.path if route is not None else "unmatched"
+        REQUEST_LATENCY.labels(route=route, method=request.method, status=status).observe(
+            time.perf_counter() - start_time
+        )
+        if profile is not None:
+            profiler.finish(profile, route, status)
+        if route not in PROBE_ROUTES:
+            startup.milestone("first_request")
 
 
-@app.get("/metrics")
-async def metrics():
-    return Response(generate_latest(), media_type="text/plain")
+def require_profile_signature(request: Request):
+    # Debug endpoints don't exist unless profiling is configured and the caller signs with its secret
+    if not profiler.enabled or not verify(request.headers.get(PROFILE_HEADER)):
+        raise HTTPException(status_code=404, detail="Not Found")
 
 
-@app.get("/example")
-async def example():
-    start_time = time.time()
-    try:
-
-        db_response_time = simulate_db_request()
-        DB_RESPONSE_LATENCY.observe(db_response_time)
-        return {"message": "success"}
-    except Exception as e:
-        DB_ERROR_COUNT.inc()
-        raise e
+@app.get("/debug/profiles", dependencies=[Depends(require_profile_signature)])
+async def list_profiles():
+    return [profile.summary() for profile in reversed(profiler.profiles)]
 
 
-def simulate_db_request():
+@app.get("/debug/profiles/{profile_id}", dependencies=[Depends(require_profile_signature)])
+async def get_profile(profile_id: str):
+    profile = profiler.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail=f"Profile {profile_id} not found")
+    return profile.to_dict()
 
-    time.sleep(0.1)
-    return 0.1
 
+@app.post("/debug/profiles/window", dependencies=[Depends(require_profile_signature)])
+async def open_profile_window(seconds: float = Query(60, gt=0, le=600)):
+    """Profile every request for the next `seconds`."""
+    profiler.open_window(seconds)
+    return {"profiling_for_seconds": seconds}
 
 
+@app.get("/metrics")
+async def metrics(request: Request):
+    accept_gzip = "gzip" in request.headers.get("accept-encoding", "")
+    headers = {"Vary": "Accept-Encoding"}
+    if accept_gzip:
+        headers["Content-Encoding"] = "gzip"
+    return Response(exposition.render(accept_gzip), media_type=CONTENT_TYPE_LATEST, headers=headers)
 
 
+startup.milestone("imported")
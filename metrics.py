@@ -0,0 +1,63 @@
+import os
+import gzip
+import time
+from prometheus_client import CollectorRegistry, REGISTRY, generate_latest, multiprocess
+
+# Set when uvicorn runs several workers: each writes its samples here and /metrics merges them
+MULTIPROCESS = bool(os.getenv("PROMETHEUS_MULTIPROC_DIR"))
+# Rendered exposition is reused for this long, so frequent scrapes don't re-serialize every series
+METRICS_CACHE_SECONDS = float(os.getenv("METRICS_CACHE_SECONDS", "1"))
+METRICS_GZIP_LEVEL = 6
+
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DEFAULT_DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+def buckets(name, default):
+    """Histogram bucket bounds from a comma-separated environment variable, e.g. METRICS_HTTP_BUCKETS=0.01,0.1,1."""
+    value = os.getenv(name)
+    if not value:
+        return default
+    return tuple(sorted(float(bound) for bound in value.split(",")))
+
+
+HTTP_BUCKETS = buckets("METRICS_HTTP_BUCKETS", DEFAULT_LATENCY_BUCKETS)
+KUBE_BUCKETS = buckets("METRICS_KUBE_BUCKETS", DEFAULT_LATENCY_BUCKETS)
+DB_BUCKETS = buckets("METRICS_DB_BUCKETS", DEFAULT_DB_BUCKETS)
+
+
+def registry():
+    if not MULTIPROCESS:
+        return REGISTRY
+    merged = CollectorRegistry()
+    multiprocess.MultiProcessCollector(merged)
+    return merged
+
+
+def mark_process_dead():
+    # Drops this worker's live* gauge files so exited workers stop counting towards them
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(os.getpid())
+
+
+class Exposition:
+    """The rendered /metrics body, plain and gzipped, reused for METRICS_CACHE_SECONDS."""
+
+    def __init__(self, ttl=METRICS_CACHE_SECONDS):
+        self.ttl = ttl
+        self._registry = registry()
+        self._rendered_at = None
+        self._plain = None
+        self._gzipped = None
+
+    def render(self, accept_gzip=False):
+        now = time.monotonic()
+        if self._rendered_at is None or now - self._rendered_at >= self.ttl:
+            self._plain = generate_latest(self._registry)
+            self._gzipped = None
+            self._rendered_at = now
+        if not accept_gzip:
+            return self._plain
+        if self._gzipped is None:
+            self._gzipped = gzip.compress(self._plain, compresslevel=METRICS_GZIP_LEVEL)
+        return self._gzipped
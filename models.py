@@ -1,5 +1,5 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey
-from db import Base, engine
+from sqlalchemy import Column, Integer, String, DateTime
+from db import Base
 
 
 class Health(Base):
@@ -7,11 +7,10 @@ class Health(Base):
     __tablename__ = 'health'
 
     id = Column(Integer, primary_key=True)
-    app_name = Column(String)
+    app_name = Column(String, unique=True, index=True)
     failure_count = Column(Integer)
     success_count = Column(Integer)
     last_failure = Column(DateTime, nullable=True)
     last_success = Column(DateTime, nullable=True)
     created_at = Column(DateTime)
-
-#Base.metadata.create_all(bind=engine)
\ No newline at end of file
+    last_error = Column(String, nullable=True)
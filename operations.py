@@ -0,0 +1,337 @@
+import os
+import asyncio
+import logging
+import time
+import uuid
+from datetime import datetime, timezone
+import asyncpg
+import orjson
+from kubernetes.aio.client.exceptions import ApiException
+import db
+import deploy
+import rightsizing
+
+logger = logging.getLogger(__name__)
+
+OPERATION_WORKERS = int(os.getenv("OPERATION_WORKERS", "8"))
+OPERATION_QUEUE_SIZE = int(os.getenv("OPERATION_QUEUE_SIZE", "1000"))
+OPERATION_RETENTION = int(os.getenv("OPERATION_RETENTION", "1000"))
+# How often idle workers look for operations submitted to other processes
+OPERATION_POLL_SECONDS = float(os.getenv("OPERATION_POLL_SECONDS", "0.5"))
+# A running operation whose lease isn't renewed within this long belonged to a process that died
+OPERATION_LEASE_SECONDS = float(os.getenv("OPERATION_LEASE_SECONDS", "60"))
+OPERATION_MAINTENANCE_SECONDS = 30
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS operation (
+        id TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        app_name TEXT NOT NULL,
+        config JSONB NOT NULL,
+        state TEXT NOT NULL,
+        submissions INTEGER NOT NULL DEFAULT 1,
+        submitted_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        started_at TIMESTAMPTZ,
+        finished_at TIMESTAMPTZ,
+        lease_expires_at TIMESTAMPTZ,
+        timings JSONB NOT NULL DEFAULT '{}',
+        result JSONB,
+        error TEXT,
+        status_code INTEGER
+    );
+    -- The one queued operation per app and kind that later submissions update in place
+    CREATE UNIQUE INDEX IF NOT EXISTS operation_queued ON operation (app_name, kind) WHERE state = 'queued';
+    -- At most one running operation per app, whichever process runs it
+    CREATE UNIQUE INDEX IF NOT EXISTS operation_running ON operation (app_name) WHERE state = 'running';
+    CREATE INDEX IF NOT EXISTS operation_next ON operation (submitted_at) WHERE state = 'queued';
+    CREATE INDEX IF NOT EXISTS operation_finished ON operation (finished_at) WHERE finished_at IS NOT NULL;
+"""
+SELECT_OPERATION = "SELECT * FROM operation WHERE id = $1"
+COUNT_QUEUED = "SELECT count(*) FROM operation WHERE state = 'queued'"
+RESUBMIT_OPERATION = """
+    UPDATE operation SET config = $3, submissions = submissions + 1
+    WHERE app_name = $1 AND kind = $2 AND state = 'queued'
+    RETURNING *
+"""
+INSERT_OPERATION = """
+    INSERT INTO operation (id, kind, app_name, config, state) VALUES ($1, $2, $3, $4, 'queued')
+    ON CONFLICT (app_name, kind) WHERE state = 'queued'
+    DO UPDATE SET config = excluded.config, submissions = operation.submissions + 1
+    RETURNING *
+"""
+# The oldest queued operation whose app has nothing running. Two processes can still pick operations for the same
+# app at once; operation_running makes the second claim fail instead of both running.
+CLAIM_OPERATION = """
+    UPDATE operation SET state = 'running', started_at = now(), lease_expires_at = now() + make_interval(secs => $1)
+    WHERE id = (
+        SELECT id FROM operation queued
+        WHERE state = 'queued' AND NOT EXISTS (
+            SELECT 1 FROM operation running WHERE running.app_name = queued.app_name AND running.state = 'running'
+        )
+        ORDER BY submitted_at LIMIT 1 FOR UPDATE SKIP LOCKED
+    )
+    RETURNING *
+"""
+RENEW_LEASE = """
+    UPDATE operation SET lease_expires_at = now() + make_interval(secs => $2) WHERE id = $1 AND state = 'running'
+"""
+FINISH_OPERATION = """
+    UPDATE operation SET state = $2, finished_at = now(), lease_expires_at = NULL, timings = $3, result = $4,
+                         error = $5, status_code = $6
+    WHERE id = $1
+"""
+FAIL_ABANDONED = """
+    UPDATE operation SET state = 'failed', finished_at = now(), lease_expires_at = NULL, status_code = 500,
+                         error = 'Abandoned by a stopped or unresponsive worker'
+    WHERE state = 'running' AND lease_expires_at < now()
+    RETURNING id
+"""
+# Keeps the newest OPERATION_RETENTION finished operations
+DELETE_FINISHED = """
+    DELETE FROM operation WHERE finished_at <= (
+        SELECT finished_at FROM operation WHERE finished_at IS NOT NULL ORDER BY finished_at DESC OFFSET $1 LIMIT 1
+    )
+"""
+
+
+class Operation:
+
+    def __init__(self, row, config_types):
+        self.id = row["id"]
+        self.kind = row["kind"]
+        self.app_name = row["app_name"]
+        self.config = config_types[self.kind](**orjson.loads(row["config"]))
+        self.state = row["state"]
+        self.submissions = row["submissions"]
+        self.submitted_at = row["submitted_at"]
+        self.started_at = row["started_at"]
+        self.finished_at = row["finished_at"]
+        self.result = orjson.loads(row["result"]) if row["result"] is not None else None
+        self.error = row["error"]
+        self.status_code = row["status_code"]
+        self.timings = orjson.loads(row["timings"])
+
+    @property
+    def done(self):
+        return self.state in ("succeeded", "failed")
+
+    def to_dict(self):
+        return {
+            "operation_id": self.id,
+            "kind": self.kind,
+            "app_name": self.app_name,
+            "state": self.state,
+            "submissions": self.submissions,
+            "submitted_at": self.submitted_at.isoformat(),
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "timings": self.timings,
+            "result": self.result,
+            "error": self.error,
+            "status_code": self.status_code,
+        }
+
+
+class OperationQueue:
+    """Runs deploy and update requests on a worker pool, with the queue itself kept in Postgres.
+
+    Every worker process and replica takes operations from the same table, so an operation can be polled from any
+    of them, and operations for the same app never run concurrently anywhere. A submission for an app that already
+    has a queued operation of the same kind replaces that operation's config instead of queueing another one.
+    Running operations hold a lease that their process renews; one that lapses is failed as abandoned.
+    """
+
+    def __init__(self, config_types, workers=OPERATION_WORKERS, maxsize=OPERATION_QUEUE_SIZE):
+        self.config_types = config_types
+        self.workers = workers
+        self.maxsize = maxsize
+        self._wakeup = asyncio.Event()
+        self._waiters = {}
+        self._running = set()
+        self._dispatcher = None
+        self._maintained_at = 0.0
+
+    def start(self):
+        self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def stop(self):
+        tasks = [self._dispatcher, *self._running] if self._dispatcher is not None else []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def submit(self, kind, config):
+        """Queue `config`, raising asyncio.QueueFull when the backlog is full."""
+        return (await self.submit_many(kind, [config]))[0]
+
+    async def submit_many(self, kind, configs):
+        """Queue every config in one transaction, raising asyncio.QueueFull unless the backlog has room for all."""
+        await db.ensure_schema("operation", SCHEMA)
+        operations = []
+        async with db.write("submit_operation") as connection:
+            queued = await connection.fetchval(COUNT_QUEUED)
+            for config in configs:
+                body = orjson.dumps(config.model_dump()).decode()
+                row = await connection.fetchrow(RESUBMIT_OPERATION, config.app_name, kind, body)
+                if row is None:
+                    if queued >= self.maxsize:
+                        raise asyncio.QueueFull
+                    queued += 1
+                    row = await connection.fetchrow(INSERT_OPERATION, uuid.uuid4().hex, kind, config.app_name, body)
+                operations.append(Operation(row, self.config_types))
+        self._wakeup.set()
+        return operations
+
+    async def get(self, operation_id):
+        await db.ensure_schema("operation", SCHEMA)
+        # From the master: the operation may have been submitted to another process a moment ago
+        async with db.timed(db.master_pool, "get_operation"), db.master_pool.acquire() as connection:
+            row = await connection.fetchrow(SELECT_OPERATION, operation_id)
+        return Operation(row, self.config_types) if row is not None else None
+
+    async def wait(self, operation_id):
+        """The operation once it has finished, whichever process ran it; None if it no longer exists."""
+        finished = asyncio.Event()
+        waiters = self._waiters.setdefault(operation_id, set())
+        waiters.add(finished)
+        try:
+            while True:
+                operation = await self.get(operation_id)
+                if operation is None or operation.done:
+                    return operation
+                try:
+                    await asyncio.wait_for(finished.wait(), OPERATION_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            waiters.discard(finished)
+            if not waiters:
+                self._waiters.pop(operation_id, None)
+
+    async def _dispatch(self):
+        slots = asyncio.Semaphore(self.workers)
+        while True:
+            await slots.acquire()
+            self._wakeup.clear()
+            idle = OPERATION_POLL_SECONDS
+            try:
+                await self._maintain()
+                operation = await self._claim()
+            except Exception as e:
+                logger.warning("could not claim an operation: %s", e)
+                operation, idle = None, OPERATION_MAINTENANCE_SECONDS / 6
+            if operation is None:
+                slots.release()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), idle)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            task = asyncio.create_task(self._run(operation))
+            self._running.add(task)
+
+            def done(task):
+                self._running.discard(task)
+                slots.release()
+
+            task.add_done_callback(done)
+
+    async def _claim(self):
+        await db.ensure_schema("operation", SCHEMA)
+        try:
+            # A single statement, so most polls, which find nothing, cost one round trip and no WAL bookkeeping
+            async with db.master("claim_operation") as connection:
+                row = await connection.fetchrow(CLAIM_OPERATION, OPERATION_LEASE_SECONDS)
+                if row is not None:
+                    await db.note_write(connection)
+        except asyncpg.UniqueViolationError:
+            # Another process claimed an operation for the same app first; try again straight away
+            self._wakeup.set()
+            return None
+        return Operation(row, self.config_types) if row is not None else None
+
+    async def _maintain(self):
+        if time.monotonic() - self._maintained_at < OPERATION_MAINTENANCE_SECONDS:
+            return
+        await db.ensure_schema("operation", SCHEMA)
+        async with db.write("maintain_operations") as connection:
+            abandoned = await connection.fetch(FAIL_ABANDONED)
+            await connection.execute(DELETE_FINISHED, OPERATION_RETENTION)
+        for row in abandoned:
+            logger.warning("operation %s was abandoned by its worker", row["id"])
+        self._maintained_at = time.monotonic()
+
+    async def _renew(self, operation):
+        while True:
+            await asyncio.sleep(OPERATION_LEASE_SECONDS / 3)
+            try:
+                async with db.write("renew_operation") as connection:
+                    await connection.execute(RENEW_LEASE, operation.id, OPERATION_LEASE_SECONDS)
+            except Exception as e:
+                logger.warning("could not renew the lease of operation %s: %s", operation.id, e)
+
+    async def _run(self, operation):
+        started = time.perf_counter()
+        operation.timings["queued"] = round((operation.started_at - operation.submitted_at).total_seconds(), 4)
+        renew = asyncio.create_task(self._renew(operation))
+        try:
+            if operation.kind == "deploy":
+                created, timings = await deploy.deploy(operation.config)
+                operation.timings.update(timings)
+                if created:
+                    message = f"Application deployment for {operation.app_name} created successfully"
+                else:
+                    message = f"Resources for {operation.app_name} updated successfully"
+                operation.result = {"message": message, "created": created}
+            elif operation.kind == "rightsize":
+                # Stamped on the StatefulSet, so the cooldown holds in every process and across restarts
+                await deploy.update_resources(operation.config, annotations={
+                    rightsizing.RIGHTSIZED_AT_ANNOTATION: datetime.now(timezone.utc).isoformat()})
+                operation.result = {"message": f"Resources for {operation.app_name} updated successfully"}
+            else:
+                await deploy.update_resources(operation.config)
+                operation.result = {"message": f"Resources for {operation.app_name} updated successfully"}
+            operation.state = "succeeded"
+        except deploy.ConfigConflict as e:
+            self._fail(operation, 409, str(e))
+        except TimeoutError:
+            self._fail(operation, 504, "Timed out waiting for the Kubernetes API")
+        except ApiException as e:
+            if operation.kind != "deploy" and e.status == 404:
+                self._fail(operation, 404, f"StatefulSet for {operation.app_name} not found")
+            elif e.status == 429:
+                # Still throttled after kube.call's own retries; bulk deploys back off and resubmit
+                self._fail(operation, 429, str(e))
+            else:
+                self._fail(operation, 400, str(e))
+        except asyncio.CancelledError:
+            self._fail(operation, 503, "Interrupted by a shutdown")
+            raise
+        except Exception as e:
+            self._fail(operation, 500, str(e))
+        finally:
+            renew.cancel()
+            operation.timings["run"] = round(time.perf_counter() - started, 4)
+            await self._finish(operation)
+
+    async def _finish(self, operation):
+        try:
+            async with db.write("finish_operation") as connection:
+                await connection.execute(
+                    FINISH_OPERATION, operation.id, operation.state, orjson.dumps(operation.timings).decode(),
+                    orjson.dumps(operation.result).decode() if operation.result is not None else None,
+                    operation.error, operation.status_code
+                )
+        except Exception:
+            # Left running; the lease lapses and it is failed as abandoned
+            logger.exception("could not record the outcome of operation %s", operation.id)
+        for finished in self._waiters.get(operation.id, ()):
+            finished.set()
+        # An operation for the same app may have been waiting on this one
+        self._wakeup.set()
+
+    @staticmethod
+    def _fail(operation, status_code, error):
+        operation.state = "failed"
+        operation.status_code = status_code
+        operation.error = error
@@ -0,0 +1,85 @@
+import hashlib
+import math
+from rightsizing import parse_quantity
+
+MB = 2 ** 20
+GB = 2 ** 30
+
+# Per workload profile: connections it expects, how much memory a sort or hash may take relative to OLTP, and how
+# much work it spreads over parallel workers
+PROFILES = {
+    "oltp": {"max_connections": 200, "work_mem_factor": 1, "maintenance_fraction": 1 / 16, "statistics_target": 100,
+             "min_wal_size": 2 * GB, "max_wal_size": 8 * GB, "parallel_per_gather_cap": 2},
+    "mixed": {"max_connections": 100, "work_mem_factor": 2, "maintenance_fraction": 1 / 16, "statistics_target": 100,
+              "min_wal_size": 1 * GB, "max_wal_size": 4 * GB, "parallel_per_gather_cap": 4},
+    "analytics": {"max_connections": 40, "work_mem_factor": 4, "maintenance_fraction": 1 / 8,
+                  "statistics_target": 500, "min_wal_size": 4 * GB, "max_wal_size": 16 * GB,
+                  "parallel_per_gather_cap": 8},
+}
+
+CONFIG_DIR = "/etc/postgresql/kaas"
+CONFIG_FILE = f"{CONFIG_DIR}/postgresql.conf"
+CONFIG_KEY = "postgresql.conf"
+
+
+def size(value):
+    """Bytes as a postgresql.conf size, in whole MB (or kB below 1MB)."""
+    if value < MB:
+        return f"{max(64, int(value // 1024))}kB"
+    return f"{int(value // MB)}MB"
+
+
+def tune(profile, memory_limit, cpu_limit):
+    """postgresql.conf settings for a container with these limits, or None if they can't be read."""
+    memory = parse_quantity(memory_limit)
+    cpus = parse_quantity(cpu_limit)
+    if not memory:
+        return None
+    settings = PROFILES[profile]
+    # Below one core Postgres still gets one worker of each kind
+    cores = max(1, math.ceil(cpus)) if cpus else 1
+    per_gather = max(1, min(settings["parallel_per_gather_cap"], cores // 2))
+    connections = settings["max_connections"]
+
+    shared_buffers = memory / 4
+    # Three sorts or hashes per connection, each parallel worker getting its own
+    work_mem = (memory - shared_buffers) / (connections * 3) / per_gather * settings["work_mem_factor"]
+    return {
+        # The Docker image's own postgresql.conf is replaced, so whatever it set that we rely on goes here too
+        "listen_addresses": "'*'",
+        "max_connections": connections,
+        "shared_buffers": size(shared_buffers),
+        # Page cache counts towards the container's memory limit, so this is the limit less shared buffers
+        "effective_cache_size": size(memory * 3 / 4),
+        "work_mem": size(work_mem),
+        "maintenance_work_mem": size(min(memory * settings["maintenance_fraction"], 2 * GB)),
+        "wal_buffers": size(min(max(shared_buffers * 0.03, 64 * 1024), 16 * MB)),
+        "min_wal_size": size(settings["min_wal_size"]),
+        "max_wal_size": size(settings["max_wal_size"]),
+        "checkpoint_completion_target": 0.9,
+        "default_statistics_target": settings["statistics_target"],
+        "random_page_cost": 1.1,
+        "effective_io_concurrency": 200,
+        "max_worker_processes": max(8, cores),
+        "max_parallel_workers": cores,
+        "max_parallel_workers_per_gather": per_gather,
+        "max_parallel_maintenance_workers": max(1, min(4, cores // 2)),
+        "dynamic_shared_memory_type": "posix",
+    }
+
+
+def render(profile, settings):
+    lines = [f"# Generated for the {profile} profile; recomputed whenever the tenant's resources change"]
+    lines += [f"{name} = {value}" for name, value in settings.items()]
+    return "\n".join(lines) + "\n"
+
+
+def postgresql_conf(profile, memory_limit, cpu_limit):
+    """The rendered postgresql.conf, or None if the limits don't allow tuning."""
+    settings = tune(profile, memory_limit, cpu_limit)
+    return render(profile, settings) if settings is not None else None
+
+
+def config_hash(conf):
+    # Put on the pod template, so a changed config rolls the pods; mounted ConfigMaps are not reloaded by Postgres
+    return hashlib.sha256(conf.encode()).hexdigest()[:16]
@@ -0,0 +1,80 @@
+import os
+import asyncio
+import base64
+from kubernetes.aio.client.exceptions import ApiException
+from prometheus_client import Counter
+from cache import TTLCache
+import kube
+
+PGBOUNCER_STATS_TTL_SECONDS = float(os.getenv("PGBOUNCER_STATS_TTL_SECONDS", "5"))
+PGBOUNCER_STATS_TIMEOUT_SECONDS = float(os.getenv("PGBOUNCER_STATS_TIMEOUT_SECONDS", "2"))
+
+PGBOUNCER_STATS_ERRORS = Counter("pgbouncer_stats_errors_total", "Failed reads of tenant PgBouncer pool stats")
+
+# SHOW POOLS columns reported, and what they're called in /status/{app_name}
+POOL_COLUMNS = {
+    "database": "Database",
+    "user": "User",
+    "pool_mode": "PoolMode",
+    "cl_active": "ClientsActive",
+    "cl_waiting": "ClientsWaiting",
+    "sv_active": "ServersActive",
+    "sv_idle": "ServersIdle",
+    "sv_used": "ServersUsed",
+    "maxwait": "MaxWaitSeconds",
+}
+
+# Cached briefly so a dashboard polling many tenants doesn't open a console connection per request
+stats_cache = TTLCache(1000, PGBOUNCER_STATS_TTL_SECONDS)
+
+
+def port_of(stateful_set):
+    """The port of the app's PgBouncer sidecar, or None if it doesn't have one."""
+    for container in stateful_set.spec.template.spec.containers:
+        if container.name.endswith("-pgbouncer"):
+            return next((port.container_port for port in container.ports or []), None)
+    return None
+
+
+def show_pools(host, port, user, password):
+    # The admin console only speaks the simple query protocol, which rules out asyncpg
+    import psycopg2
+    connection = psycopg2.connect(host=host, port=port, user=user, password=password, dbname="pgbouncer",
+                                  connect_timeout=max(1, round(PGBOUNCER_STATS_TIMEOUT_SECONDS)))
+    try:
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            cursor.execute("SHOW POOLS")
+            columns = [column.name for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+    finally:
+        connection.close()
+
+
+async def stats(app_name, port):
+    """PgBouncer's pools for the app as {"Pools": [...], "Error": None}, with the error instead if unreachable."""
+    hit, result = stats_cache.get(app_name)
+    if hit:
+        return result
+    generation = stats_cache.generation
+    try:
+        secret = await kube.shared(kube.core_v1.read_namespaced_secret, name=f"{app_name}-secret",
+                                   namespace="default")
+        user, password = (base64.b64decode(secret.data[key]).decode() for key in ("DB_USER", "DB_PASSWORD"))
+        pools = await asyncio.wait_for(
+            asyncio.to_thread(show_pools, f"{app_name}-service", port, user, password),
+            PGBOUNCER_STATS_TIMEOUT_SECONDS + 1,
+        )
+        result = {
+            "Pools": [{name: pool.get(column) for column, name in POOL_COLUMNS.items()}
+                      for pool in pools if pool.get("database") != "pgbouncer"],
+            "Error": None,
+        }
+    except ApiException as e:
+        result = {"Pools": [], "Error": f"Could not read {app_name}-secret: {e.status} {e.reason}"}
+    except Exception as e:
+        result = {"Pools": [], "Error": (str(e) or type(e).__name__).strip()}
+    if result["Error"] is not None:
+        PGBOUNCER_STATS_ERRORS.inc()
+    stats_cache.put(app_name, result, generation)
+    return result
@@ -1,11 +1,21 @@
-from kubernetes import client, config
-from fastapi import HTTPException
-from kubernetes.client import ApiException
+"""Creates or updates the health database: its secret and ConfigMap, master and replica StatefulSets, their volume
+claims and Services.
 
-#from main import core_v1, apps_v1
+Every object is compared with what is live and only changed objects are written, using server-side apply, so a
+run with nothing to change makes no writes and never recreates a Service (and its load balancer).
 
+    python postgres_conf.py [--dry-run]
+"""
+import argparse
+import base64
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from kubernetes import client, config
+from kubernetes.client import ApiException
+from cluster import in_cluster
 
-config.load_incluster_config()
+NAMESPACE = "default"
+FIELD_MANAGER = "kaas-postgres-conf"
 
 secret = client.V1Secret(
     metadata=client.V1ObjectMeta(name="postgresql-secret"),
@@ -231,7 +241,7 @@ master_pvc = client.V1PersistentVolumeClaim(
     metadata=client.V1ObjectMeta(name="postgresql-master-pvc"),
     spec=client.V1PersistentVolumeClaimSpec(
         access_modes=["ReadWriteOnce"],
-        resources=client.V1ResourceRequirements(
+        resources=client.V1VolumeResourceRequirements(
             requests={"storage": "10Gi"}
         )
     )
@@ -241,73 +251,109 @@ slave_pvc = client.V1PersistentVolumeClaim(
     metadata=client.V1ObjectMeta(name="postgresql-slave-pvc"),
     spec=client.V1PersistentVolumeClaimSpec(
         access_modes=["ReadWriteOnce"],
-        resources=client.V1ResourceRequirements(
+        resources=client.V1VolumeResourceRequirements(
             requests={"storage": "10Gi"}
         )
     )
 )
 
-apps_v1 = client.AppsV1Api()
-core_v1 = client.CoreV1Api()
-try:
-    #core_v1.delete_namespaced_persistent_volume_claim(namespace="default", name=master_pvc.metadata.name)
-    core_v1.read_namespaced_persistent_volume_claim(namespace="default", name=master_pvc.metadata.name)
-
-except client.exceptions.ApiException as e:
-    if e.status == 404:
-        core_v1.create_namespaced_persistent_volume_claim(namespace="default", body=master_pvc)
-
-try:
-    #core_v1.delete_namespaced_persistent_volume_claim(namespace="default", name=slave_pvc.metadata.name)
-    core_v1.read_namespaced_persistent_volume_claim(namespace="default", name=slave_pvc.metadata.name)
-
-except client.exceptions.ApiException as e:
-    if e.status == 404:
-        core_v1.create_namespaced_persistent_volume_claim(namespace="default", body=slave_pvc)
-
-try:
-    #apps_v1.delete_namespaced_stateful_set(namespace="default", name=slave_stateful_set.metadata.name)
-    apps_v1.read_namespaced_stateful_set(namespace="default", name=slave_stateful_set.metadata.name)
-
+# Applied in order; the objects within a wave don't depend on each other and are applied in parallel
+WAVES = [
+    [secret, config_map, master_pvc, slave_pvc, master_service, slave_service],
+    [master_stateful_set, slave_stateful_set],
+]
 
-except client.exceptions.ApiException as e:
-    if e.status == 404:
-        apps_v1.create_namespaced_stateful_set(namespace="default", body=slave_stateful_set)
 
+def manifest(obj, api_client):
+    """`obj` as the API server would render it, with apiVersion and kind for server-side apply."""
+    body = api_client.sanitize_for_serialization(obj)
+    kind = type(obj).__name__.removeprefix("V1")
+    body = {"apiVersion": "apps/v1" if kind == "StatefulSet" else "v1", "kind": kind, **body}
+    body["metadata"]["namespace"] = NAMESPACE
+    if "stringData" in body:
+        # Live secrets only ever show `data`, so apply and compare in that form
+        body["data"] = {key: base64.b64encode(value.encode()).decode() for key, value in body.pop("stringData").items()}
+    return body
 
-try:
-    #apps_v1.delete_namespaced_stateful_set(namespace="default", name=master_stateful_set.metadata.name)
-    apps_v1.read_namespaced_stateful_set(namespace="default", name=master_stateful_set.metadata.name)
 
-except client.exceptions.ApiException as e:
-    if e.status == 404:
-        apps_v1.create_namespaced_stateful_set(namespace="default", body=master_stateful_set)
+def diff(desired, live, path=""):
+    """Paths in `desired` whose value differs in `live`. Fields only set in `live` (defaults, status) don't count."""
+    if isinstance(desired, dict):
+        if not isinstance(live, dict):
+            return [path or "."]
+        return [change for key, value in desired.items() for change in diff(value, live.get(key), f"{path}.{key}" if path else key)]
+    if isinstance(desired, list):
+        if not isinstance(live, list) or len(live) != len(desired):
+            return [path]
+        return [change for i, (value, live_value) in enumerate(zip(desired, live))
+                for change in diff(value, live_value, f"{path}[{i}]")]
+    return [] if desired == live else [path]
 
-try:
 
-    core_v1.delete_namespaced_service(namespace="default", name=slave_service.metadata.name)
-    core_v1.read_namespaced_service(namespace="default", name=slave_service.metadata.name)
+def api_methods(kind, api_client):
+    # StatefulSet -> (apps_v1.read_namespaced_stateful_set, apps_v1.patch_namespaced_stateful_set)
+    api = client.AppsV1Api(api_client) if kind == "StatefulSet" else client.CoreV1Api(api_client)
+    resource = "".join(f"_{c.lower()}" if c.isupper() else c for c in kind).lstrip("_")
+    return getattr(api, f"read_namespaced_{resource}"), getattr(api, f"patch_namespaced_{resource}")
 
-except client.exceptions.ApiException as e:
-    if e.status == 404:
-        core_v1.create_namespaced_service(namespace="default", body=slave_service)
 
-try:
+def reconcile(obj, api_client, dry_run=False):
+    """Apply `obj` if it differs from the live object. Returns (name, outcome, changed paths)."""
+    body = manifest(obj, api_client)
+    name = f"{body['kind'].lower()}/{body['metadata']['name']}"
+    read, patch = api_methods(body["kind"], api_client)
+    try:
+        live = api_client.sanitize_for_serialization(read(name=body["metadata"]["name"], namespace=NAMESPACE))
+        changes = diff(body, live)
+        outcome = "updated"
+    except ApiException as e:
+        if e.status != 404:
+            raise
+        changes = ["."]
+        outcome = "created"
+    if not changes:
+        return name, "unchanged", []
+    patch(name=body["metadata"]["name"], namespace=NAMESPACE, body=body, field_manager=FIELD_MANAGER, force=True,
+          dry_run="All" if dry_run else None, _content_type="application/apply-patch+yaml")
+    return name, outcome, changes
 
-    core_v1.delete_namespaced_service(namespace="default", name=master_service.metadata.name)
-    core_v1.read_namespaced_service(namespace="default", name=master_service.metadata.name)
 
-except client.exceptions.ApiException as e:
-    if e.status == 404:
-        core_v1.create_namespaced_service(namespace="default", body=master_service)
+def main():
+    parser = argparse.ArgumentParser(description="Reconcile the health database's Kubernetes objects")
+    parser.add_argument("--dry-run", action="store_true", help="Report what would change without changing it")
+    args = parser.parse_args()
+    if in_cluster():
+        config.load_incluster_config()
+    else:
+        config.load_kube_config()
+    configuration = client.Configuration.get_default_copy()
+    # One connection per object applied in parallel
+    configuration.connection_pool_maxsize = max(len(wave) for wave in WAVES)
+    with client.ApiClient(configuration) as api_client:
+        return apply_waves(api_client, args.dry_run)
 
-try:
-    core_v1.delete_namespaced_secret(namespace="default", name=secret.metadata.name)
-    core_v1.create_namespaced_secret(namespace="default", body=secret)
-    core_v1.delete_namespaced_config_map(namespace="default", name=config_map.metadata.name)
-    core_v1.create_namespaced_config_map(namespace="default", body=config_map)
 
-except client.exceptions.ApiException as e:
-    raise HTTPException(status_code=400, detail=str(e))
+def apply_waves(api_client, dry_run):
+    changed = failed = 0
+    for wave in WAVES:
+        with ThreadPoolExecutor(max_workers=len(wave)) as pool:
+            futures = [pool.submit(reconcile, obj, api_client, dry_run) for obj in wave]
+        for obj, future in zip(wave, futures):
+            try:
+                name, outcome, changes = future.result()
+            except ApiException as e:
+                failed += 1
+                print(f"{type(obj).__name__.removeprefix('V1').lower()}/{obj.metadata.name}: failed: "
+                      f"{e.status} {e.reason}")
+                continue
+            if outcome != "unchanged":
+                changed += 1
+                if dry_run:
+                    outcome = f"would be {outcome}"
+            print(f"{name}: {outcome}" + (f" ({', '.join(changes)})" if outcome.endswith("updated") else ""))
+    print(f"{changed} changed, {failed} failed" + (" (dry run)" if dry_run else ""))
+    return 1 if failed else 0
 
 
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,177 @@
+import os
+import sys
+import hmac
+import hashlib
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from datetime import datetime, timezone
+
+# Profiling is off entirely unless a secret is configured to sign X-Profile headers with
+PROFILE_SECRET = os.getenv("PROFILE_SECRET", "")
+PROFILE_INTERVAL_SECONDS = float(os.getenv("PROFILE_INTERVAL_SECONDS", "0.005"))
+PROFILE_BUFFER_SIZE = int(os.getenv("PROFILE_BUFFER_SIZE", "50"))
+PROFILE_MAX_WINDOW_SECONDS = 600
+PROFILE_MAX_STACK_DEPTH = 64
+PROFILE_TOP_STACKS = 25
+PROFILE_HEADER = "x-profile"
+
+# First match wins, checked from the innermost frame outwards
+CATEGORIES = (
+    ("deserialization", ("deserialize", "sanitize_for_serialization", "/pydantic/")),
+    ("json_encoding", ("/json/", "/fastapi/encoders.py", "jsonable_encoder", "/orjson")),
+    ("database", ("/asyncpg/", "/sqlalchemy/")),
+    ("kubernetes", ("/kubernetes/", "/aiohttp/")),
+)
+
+
+def sign(expires_at, secret=PROFILE_SECRET):
+    """X-Profile header value valid until unix time `expires_at`."""
+    digest = hmac.new(secret.encode(), str(int(expires_at)).encode(), hashlib.sha256).hexdigest()
+    return f"{int(expires_at)}.{digest}"
+
+
+def verify(value, secret=PROFILE_SECRET):
+    if not secret or not value:
+        return False
+    expires_at, _, digest = value.partition(".")
+    if not expires_at.isdigit() or int(expires_at) < time.time():
+        return False
+    return hmac.compare_digest(sign(int(expires_at), secret), value)
+
+
+def categorize(frames):
+    """Where a sample's time went, judged from its (innermost first) frames."""
+    if frames and frames[0].endswith(("selectors.py:select", "base_events.py:_run_once")):
+        return "idle"
+    for frame in frames:
+        for category, markers in CATEGORIES:
+            if any(marker in frame for marker in markers):
+                return category
+    return "app"
+
+
+class Profile:
+
+    def __init__(self, request):
+        self.id = uuid.uuid4().hex
+        self.method = request.method
+        self.path = request.url.path
+        self.route = None
+        self.status = None
+        self.started_at = datetime.now(timezone.utc)
+        self.start = time.perf_counter()
+        self.duration = None
+        self.samples = 0
+        self.categories = Counter()
+        self.stacks = Counter()
+
+    def add(self, stack, category):
+        self.samples += 1
+        self.categories[category] += 1
+        self.stacks[stack] += 1
+
+    def summary(self):
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "route": self.route,
+            "status": self.status,
+            "started_at": self.started_at.isoformat(),
+            "duration_seconds": round(self.duration, 4) if self.duration is not None else None,
+            "samples": self.samples,
+            "categories": {
+                category: round(count / self.samples, 3) for category, count in self.categories.most_common()
+            } if self.samples else {},
+        }
+
+    def to_dict(self):
+        return {
+            **self.summary(),
+            "interval_seconds": PROFILE_INTERVAL_SECONDS,
+            # Collapsed stacks, outermost frame first, in the format flame graph tools take
+            "stacks": [
+                {"stack": stack, "samples": count} for stack, count in self.stacks.most_common(PROFILE_TOP_STACKS)
+            ],
+        }
+
+
+class Profiler:
+    """Samples the event loop thread's stack while profiled requests are in flight.
+
+    A request is profiled when it carries a valid signed X-Profile header or arrives during an admin-opened window.
+    Samples are taken of the whole loop, so anything running concurrently with a profiled request shows up in its
+    profile too. When nothing is being profiled no sampling thread runs and begin() costs a header lookup.
+    """
+
+    def __init__(self, interval=PROFILE_INTERVAL_SECONDS, buffer_size=PROFILE_BUFFER_SIZE):
+        self.interval = interval
+        self.profiles = deque(maxlen=buffer_size)
+        self.window_until = 0.0
+        self._active = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._thread_id = None
+
+    @property
+    def enabled(self):
+        return bool(PROFILE_SECRET)
+
+    def open_window(self, seconds):
+        self.window_until = time.monotonic() + min(seconds, PROFILE_MAX_WINDOW_SECONDS)
+        return self.window_until
+
+    def begin(self, request):
+        if not self.window_until and PROFILE_HEADER not in request.headers:
+            return None
+        if request.url.path.startswith("/debug/"):
+            return None
+        in_window = time.monotonic() < self.window_until
+        if not in_window:
+            self.window_until = 0.0
+            if not verify(request.headers.get(PROFILE_HEADER)):
+                return None
+        profile = Profile(request)
+        with self._lock:
+            self._active.add(profile)
+            self._thread_id = threading.get_ident()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._sample, name="profiler", daemon=True)
+                self._thread.start()
+        return profile
+
+    def finish(self, profile, route, status):
+        profile.duration = time.perf_counter() - profile.start
+        profile.route = route
+        profile.status = status
+        with self._lock:
+            self._active.discard(profile)
+        self.profiles.append(profile)
+
+    def get(self, profile_id):
+        return next((profile for profile in self.profiles if profile.id == profile_id), None)
+
+    def _sample(self):
+        while True:
+            with self._lock:
+                if not self._active:
+                    self._thread = None
+                    return
+                active = list(self._active)
+                thread_id = self._thread_id
+            frame = sys._current_frames().get(thread_id)
+            frames = []
+            while frame is not None and len(frames) < PROFILE_MAX_STACK_DEPTH:
+                code = frame.f_code
+                frames.append(f"{code.co_filename}:{code.co_name}")
+                frame = frame.f_back
+            category = categorize(frames)
+            stack = ";".join(
+                f"{os.path.basename(filename)}:{name}"
+                for filename, _, name in (entry.rpartition(":") for entry in reversed(frames))
+            )
+            for profile in active:
+                profile.add(stack, category)
+            time.sleep(self.interval)
@@ -0,0 +1,315 @@
+import os
+import asyncio
+import logging
+import math
+import re
+import time
+from datetime import datetime, timezone
+from kubernetes.aio.client.exceptions import ApiException
+from prometheus_client import Counter, Histogram
+import db
+import kube
+from metrics import KUBE_BUCKETS
+
+logger = logging.getLogger(__name__)
+
+# off: don't sample; recommend: sample and serve recommendations; apply: also submit them as resource updates
+RIGHTSIZING_MODE = os.getenv("RIGHTSIZING_MODE", "recommend")
+RIGHTSIZING_INTERVAL_SECONDS = float(os.getenv("RIGHTSIZING_INTERVAL_SECONDS", "60"))
+# Samples lose half their weight every half-life, so recommendations follow a tenant's recent usage
+RIGHTSIZING_HALF_LIFE_SECONDS = float(os.getenv("RIGHTSIZING_HALF_LIFE_SECONDS", str(24 * 3600)))
+RIGHTSIZING_MIN_SAMPLES = int(os.getenv("RIGHTSIZING_MIN_SAMPLES", "60"))
+RIGHTSIZING_MARGIN = float(os.getenv("RIGHTSIZING_MARGIN", "0.15"))
+# Hysteresis: only apply when some value is off by more than this fraction, and not again within the cooldown
+RIGHTSIZING_TOLERANCE = float(os.getenv("RIGHTSIZING_TOLERANCE", "0.2"))
+RIGHTSIZING_COOLDOWN_SECONDS = float(os.getenv("RIGHTSIZING_COOLDOWN_SECONDS", str(6 * 3600)))
+# Memory limit growth after an OOM kill, on top of the current limit
+RIGHTSIZING_OOM_BUMP = 1.2
+RIGHTSIZED_AT_ANNOTATION = "kaas/rightsized-at"
+
+# Each bucket is 5% wider than the last, so percentiles are accurate to 5% in a few dozen buckets per tenant
+BUCKET_GROWTH = 1.05
+CPU_FIRST_BUCKET = 0.001
+MEMORY_FIRST_BUCKET = 2 ** 20
+MIN_CPU = 0.01
+MIN_MEMORY = 64 * 2 ** 20
+CPU_STEP = 0.01
+MEMORY_STEP = 16 * 2 ** 20
+
+RIGHTSIZING_SAMPLE_DURATION = Histogram("rightsizing_sample_seconds", "Duration of a pod usage sampling cycle",
+                                        buckets=KUBE_BUCKETS)
+RIGHTSIZING_SAMPLES = Counter("rightsizing_samples_total", "Pod usage samples recorded")
+RIGHTSIZING_SAMPLE_ERRORS = Counter("rightsizing_sample_errors_total", "Failed pod usage sampling cycles")
+RIGHTSIZING_APPLIED = Counter("rightsizing_applied_total", "Resource updates submitted by the right-sizer")
+
+QUANTITY = re.compile(r"([0-9.]+(?:[eE][-+]?[0-9]+)?)([a-zA-Z]*)")
+SUFFIXES = {
+    "n": 1e-9, "u": 1e-6, "m": 1e-3, "": 1, "k": 1e3, "M": 1e6, "G": 1e9, "T": 1e12,
+    "Ki": 2 ** 10, "Mi": 2 ** 20, "Gi": 2 ** 30, "Ti": 2 ** 40,
+}
+
+
+def parse_quantity(value):
+    """A Kubernetes quantity ("250m", "1.5", "512Mi") as a float, or None if it isn't one."""
+    match = QUANTITY.fullmatch(str(value)) if value is not None else None
+    if match is None or match.group(2) not in SUFFIXES:
+        return None
+    return float(match.group(1)) * SUFFIXES[match.group(2)]
+
+
+def format_cpu(cores):
+    return f"{round(max(math.ceil(cores / CPU_STEP) * CPU_STEP, MIN_CPU) * 1000)}m"
+
+
+def format_memory(size):
+    return f"{max(math.ceil(size / MEMORY_STEP) * MEMORY_STEP, MIN_MEMORY) // 2 ** 20}Mi"
+
+
+class UsageHistogram:
+    """Exponentially bucketed, exponentially decaying histogram of one resource's usage, as kept by the VPA.
+
+    Instead of decaying every bucket on each sample, newer samples are added with exponentially growing weight;
+    the weights are rescaled before they could overflow.
+    """
+
+    def __init__(self, first_bucket, half_life=RIGHTSIZING_HALF_LIFE_SECONDS):
+        self.first_bucket = first_bucket
+        self.half_life = half_life
+        self.weights = {}
+        self.total = 0.0
+        self.samples = 0
+        self._reference = time.monotonic()
+
+    def add(self, value, now=None):
+        now = time.monotonic() if now is None else now
+        exponent = (now - self._reference) / self.half_life
+        if exponent > 50:
+            scale = 2 ** -exponent
+            self.weights = {index: weight * scale for index, weight in self.weights.items() if weight * scale > 1e-9}
+            self.total = sum(self.weights.values())
+            self._reference, exponent = now, 0.0
+        if value <= self.first_bucket:
+            index = 0
+        else:
+            index = math.ceil(math.log(value / self.first_bucket, BUCKET_GROWTH))
+        weight = 2 ** exponent
+        self.weights[index] = self.weights.get(index, 0.0) + weight
+        self.total += weight
+        self.samples += 1
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the `fraction` quantile, or None while empty."""
+        if not self.total:
+            return None
+        threshold = fraction * self.total
+        seen = 0.0
+        for index in sorted(self.weights):
+            seen += self.weights[index]
+            if seen >= threshold:
+                return self.first_bucket * BUCKET_GROWTH ** index
+        return self.first_bucket * BUCKET_GROWTH ** max(self.weights)
+
+
+class AppUsage:
+
+    def __init__(self):
+        self.cpu = UsageHistogram(CPU_FIRST_BUCKET)
+        self.memory = UsageHistogram(MEMORY_FIRST_BUCKET)
+        self.last_applied = None
+
+    def summary(self):
+        summary = {}
+        for resource, histogram, formatter in (("cpu", self.cpu, format_cpu), ("memory", self.memory, format_memory)):
+            summary[resource] = {f"p{round(fraction * 100)}": formatter(histogram.percentile(fraction))
+                                 for fraction in (0.5, 0.9, 0.99)} if histogram.total else {}
+        return summary
+
+
+def container_of(app_name, containers, name_of):
+    # The tenant's own container, not a sidecar
+    return next((container for container in containers if name_of(container) == f"{app_name}-container"),
+                containers[0] if containers else None)
+
+
+def current_resources(stateful_set):
+    app_name = (stateful_set.spec.selector.match_labels or {}).get("app")
+    container = container_of(app_name, stateful_set.spec.template.spec.containers, lambda container: container.name)
+    resources = container.resources if container is not None else None
+    requests = (resources.requests if resources else None) or {}
+    limits = (resources.limits if resources else None) or {}
+    return {
+        "cpu_request": requests.get("cpu"),
+        "cpu_limit": limits.get("cpu"),
+        "memory_request": requests.get("memory"),
+        "memory_limit": limits.get("memory"),
+    }
+
+
+def differs(current, recommended):
+    """True if any recommended value is more than RIGHTSIZING_TOLERANCE away from the current one."""
+    for key, value in recommended.items():
+        have = parse_quantity(current[key])
+        if have is None or abs(parse_quantity(value) - have) > RIGHTSIZING_TOLERANCE * have:
+            return True
+    return False
+
+
+def rightsized_at(stateful_set):
+    """When the right-sizer last resized the tenant, as stamped on its StatefulSet, or None."""
+    stamp = (stateful_set.metadata.annotations or {}).get(RIGHTSIZED_AT_ANNOTATION)
+    try:
+        return datetime.fromisoformat(stamp) if stamp else None
+    except ValueError:
+        return None
+
+
+def oom_killed_since(pods, since):
+    for pod in pods:
+        for status in (pod.status.container_statuses or []) if pod.status else []:
+            terminated = status.last_state.terminated if status.last_state else None
+            if terminated is not None and terminated.reason == "OOMKilled":
+                if since is None or (terminated.finished_at and terminated.finished_at > since):
+                    return True
+    return False
+
+
+class Rightsizer:
+    """Samples every tenant pod's CPU and memory from the metrics API and recommends requests and limits.
+
+    Requests cover the 90th percentile of recent usage and limits the 99th, both with RIGHTSIZING_MARGIN of
+    headroom; a tenant OOM-killed since its last change gets a larger memory limit than it has now. In apply mode
+    a recommendation is submitted as a resource update once the tenant has enough samples, when some value is off
+    by more than RIGHTSIZING_TOLERANCE, and not within RIGHTSIZING_COOLDOWN_SECONDS of its last update.
+
+    Every worker and replica samples and recommends, but only the one holding the rightsizing advisory lock
+    applies. The time of the last update is read back from the StatefulSet, so the cooldown survives restarts
+    and a change of lock holder.
+    """
+
+    def __init__(self, status_cache, submit, mode=RIGHTSIZING_MODE, interval=RIGHTSIZING_INTERVAL_SECONDS):
+        self.status_cache = status_cache
+        self.submit = submit
+        self.mode = mode
+        self.interval = interval
+        self.usage = {}
+        self.lock = db.AdvisoryLock("rightsizing")
+        self._task = None
+
+    def start(self):
+        if self.mode != "off":
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        await self.lock.release()
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("rightsizing cycle failed")
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self):
+        try:
+            await self.sample()
+        except (ApiException, TimeoutError) as e:
+            RIGHTSIZING_SAMPLE_ERRORS.inc()
+            logger.warning("could not sample pod usage: %s", e)
+            return
+        if self.mode == "apply" and self.status_cache.synced and await self.lock.held():
+            for recommendation in self.recommendations():
+                if recommendation["apply"]:
+                    await self.apply(recommendation)
+
+    async def sample(self):
+        start = time.perf_counter()
+        metrics = await kube.call(kube.custom_objects.list_namespaced_custom_object, group="metrics.k8s.io",
+                                  version="v1beta1", namespace="default", plural="pods", label_selector="app")
+        now = time.monotonic()
+        for item in metrics.get("items", []):
+            app_name = (item["metadata"].get("labels") or {}).get("app")
+            container = container_of(app_name, item.get("containers") or [], lambda container: container["name"])
+            if container is None:
+                continue
+            usage = self.usage.setdefault(app_name, AppUsage())
+            cpu = parse_quantity(container["usage"].get("cpu"))
+            memory = parse_quantity(container["usage"].get("memory"))
+            if cpu is not None:
+                usage.cpu.add(cpu, now)
+            if memory is not None:
+                usage.memory.add(memory, now)
+            RIGHTSIZING_SAMPLES.inc()
+        if self.status_cache.synced:
+            known = {app_name for app_name, _, _ in self.status_cache.list_apps()}
+            for app_name in set(self.usage) - known:
+                del self.usage[app_name]
+        RIGHTSIZING_SAMPLE_DURATION.observe(time.perf_counter() - start)
+
+    def recommendations(self):
+        return [self.recommend(app_name, stateful_set, pods)
+                for app_name, stateful_set, pods in self.status_cache.list_apps() if app_name in self.usage]
+
+    def recommendation(self, app_name):
+        found = self.status_cache.get_app(app_name)
+        if found is None or app_name not in self.usage:
+            return None
+        return self.recommend(app_name, *found)
+
+    def recommend(self, app_name, stateful_set, pods):
+        usage = self.usage[app_name]
+        current = current_resources(stateful_set)
+        # The local time covers an update submitted here that hasn't stamped the StatefulSet yet
+        last_applied = max(filter(None, (rightsized_at(stateful_set), usage.last_applied)), default=None)
+        result = {
+            "app_name": app_name,
+            "samples": min(usage.cpu.samples, usage.memory.samples),
+            "usage": usage.summary(),
+            "current": current,
+            "recommended": None,
+            "oom_killed": False,
+            "apply": False,
+            "last_applied": last_applied.isoformat() if last_applied else None,
+        }
+        if result["samples"] < RIGHTSIZING_MIN_SAMPLES:
+            return result
+
+        headroom = 1 + RIGHTSIZING_MARGIN
+        cpu_request = usage.cpu.percentile(0.9) * headroom
+        memory_request = usage.memory.percentile(0.9) * headroom
+        memory_limit = max(usage.memory.percentile(0.99) * headroom, memory_request)
+        result["oom_killed"] = oom_killed_since(pods, last_applied)
+        current_memory_limit = parse_quantity(current["memory_limit"])
+        if result["oom_killed"] and current_memory_limit:
+            memory_limit = max(memory_limit, current_memory_limit * RIGHTSIZING_OOM_BUMP)
+        recommended = {
+            "cpu_request": format_cpu(cpu_request),
+            "cpu_limit": format_cpu(max(usage.cpu.percentile(0.99) * headroom, cpu_request)),
+            "memory_request": format_memory(memory_request),
+            "memory_limit": format_memory(memory_limit),
+        }
+        result["recommended"] = recommended
+
+        cooling_down = last_applied is not None and (
+            datetime.now(timezone.utc) - last_applied).total_seconds() < RIGHTSIZING_COOLDOWN_SECONDS
+        # An OOM kill is acted on straight away: waiting out the cooldown only means more kills
+        result["apply"] = result["oom_killed"] or (differs(current, recommended) and not cooling_down)
+        return result
+
+    async def apply(self, recommendation):
+        app_name = recommendation["app_name"]
+        try:
+            await self.submit(app_name, recommendation["recommended"])
+        except asyncio.QueueFull:
+            logger.warning("operation queue full, rightsizing of %s deferred", app_name)
+            return
+        except Exception as e:
+            logger.warning("could not submit rightsizing of %s: %s", app_name, e)
+            return
+        self.usage[app_name].last_applied = datetime.now(timezone.utc)
+        RIGHTSIZING_APPLIED.inc()
+        logger.info("rightsizing %s from %s to %s", app_name, recommendation["current"],
+                    recommendation["recommended"])
@@ -0,0 +1,26 @@
+import time
+import logging
+from prometheus_client import Histogram
+
+logger = logging.getLogger(__name__)
+
+# Taken when main.py imports this module, first thing, so "imported" covers main's own imports
+STARTED = time.perf_counter()
+
+STARTUP_BUCKETS = (0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 7.5, 10.0, 15.0, 30.0, 60.0)
+
+APP_STARTUP_SECONDS = Histogram("app_startup_seconds",
+                                "Seconds from the start of main.py's import until each startup milestone",
+                                ["phase"], buckets=STARTUP_BUCKETS)
+
+_reached = set()
+
+
+def milestone(phase):
+    """Record the first time this process reaches `phase`; later calls are a set lookup."""
+    if phase in _reached:
+        return
+    _reached.add(phase)
+    elapsed = time.perf_counter() - STARTED
+    APP_STARTUP_SECONDS.labels(phase=phase).observe(elapsed)
+    logger.info("startup: %s after %.3fs", phase, elapsed)
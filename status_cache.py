@@ -0,0 +1,223 @@
+import os
+import asyncio
+import threading
+import time
+import logging
+from kubernetes.aio import watch
+from kubernetes.aio.client.exceptions import ApiException
+from prometheus_client import Gauge
+from metrics import MULTIPROCESS
+import kube
+
+logger = logging.getLogger(__name__)
+
+NAMESPACE = "default"
+RESYNC_SECONDS = int(os.getenv("STATUS_CACHE_RESYNC_SECONDS", "300"))
+RETRY_SECONDS = 5
+# Client-side limit on a watch request, past the server-side RESYNC_SECONDS at which it normally ends
+WATCH_TIMEOUT_SLACK_SECONDS = 30
+
+STATUS_CACHE_STALENESS = Gauge("status_cache_staleness_seconds",
+                               "Seconds since the status cache last heard from the Kubernetes API")
+# Staleness is computed on collection, which multiprocess mode can't do; there, alert on time() - this instead
+STATUS_CACHE_LAST_UPDATE = Gauge("status_cache_last_update_timestamp_seconds",
+                                 "Unix time the status cache last heard from the Kubernetes API",
+                                 multiprocess_mode="livemin")
+STATUS_CACHE_OBJECTS = Gauge("status_cache_objects", "Objects held in the status cache", ["kind"],
+                             multiprocess_mode="livemax")
+
+
+def app_name_of_stateful_set(name):
+    # "<app>-statefulset" -> "<app>"
+    return name.rsplit("-", 1)[0]
+
+
+def app_label_of_stateful_set(stateful_set):
+    labels = stateful_set.spec.selector.match_labels or {}
+    return labels.get("app") or app_name_of_stateful_set(stateful_set.metadata.name)
+
+
+def app_label_of_pod(pod):
+    return (pod.metadata.labels or {}).get("app")
+
+
+class _Informer:
+    """Keeps one kind of object in sync through list + watch, relisting on expiry and every resync period."""
+
+    def __init__(self, cache, kind, api, method, key_func, **list_kwargs):
+        self.cache = cache
+        self.kind = kind
+        self.api = api
+        self.method = method
+        self.list_func = None
+        self.key_func = key_func
+        self.list_kwargs = list_kwargs
+        self.synced = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self):
+        # The API class may still be being built by kube.warm(); building it here would block the loop for a second
+        api = await asyncio.to_thread(getattr, kube, self.api)
+        self.list_func = getattr(api, self.method)
+        while True:
+            try:
+                resource_version = await self._list()
+                await self._watch_from(resource_version)
+            except ApiException as e:
+                if e.status != 410:
+                    logger.warning("status cache %s watch failed: %s", self.kind, e)
+                    await asyncio.sleep(RETRY_SECONDS)
+            except Exception:
+                logger.exception("status cache %s watch failed", self.kind)
+                await asyncio.sleep(RETRY_SECONDS)
+
+    async def _list(self):
+        result = await self.list_func(namespace=NAMESPACE, **self.list_kwargs)
+        self.cache.replace(self.kind, result.items, self.key_func)
+        self.synced.set()
+        return result.metadata.resource_version
+
+    async def _watch_from(self, resource_version):
+        # The watch ends after RESYNC_SECONDS, which sends us back to a full relist.
+        stream = watch.Watch().stream(self.list_func, namespace=NAMESPACE, resource_version=resource_version,
+                                      timeout_seconds=RESYNC_SECONDS, allow_watch_bookmarks=True,
+                                      _request_timeout=RESYNC_SECONDS + WATCH_TIMEOUT_SLACK_SECONDS,
+                                      **self.list_kwargs)
+        async for event in stream:
+            if event["type"] == "BOOKMARK":
+                self.cache.touch()
+                continue
+            self.cache.apply(self.kind, event["type"], event["object"], self.key_func)
+
+
+class StatusCache:
+    """In-process view of StatefulSets and Pods, indexed by their `app` label."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._objects = {"statefulset": {}, "pod": {}}
+        self._keys = {"statefulset": {}, "pod": {}}
+        self._last_update = None
+        # Bumped on every change, and per app for changes to that app's objects; a relist bumps the epoch instead
+        self.generation = 0
+        self._epoch = 0
+        self._app_versions = {}
+        self._listeners = []
+        self._informers = [
+            _Informer(self, "statefulset", "apps_v1", "list_namespaced_stateful_set", app_label_of_stateful_set),
+            _Informer(self, "pod", "core_v1", "list_namespaced_pod", app_label_of_pod, label_selector="app"),
+        ]
+        if not MULTIPROCESS:
+            STATUS_CACHE_STALENESS.set_function(self.staleness)
+
+    def start(self):
+        """Start the informers on the running loop, through kube's client; kube.connect() must have been awaited."""
+        for informer in self._informers:
+            informer.start()
+
+    async def stop(self):
+        await asyncio.gather(*(informer.stop() for informer in self._informers))
+
+    @property
+    def synced(self):
+        return all(informer.synced.is_set() for informer in self._informers)
+
+    def staleness(self):
+        if self._last_update is None:
+            return float("inf")
+        return time.monotonic() - self._last_update
+
+    def add_listener(self, listener):
+        """Call `listener(apps)` after every change with the app names touched, or None after a relist.
+
+        Listeners run on the event loop, inside the informers, and must not block.
+        """
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def _notify(self, apps):
+        for listener in list(self._listeners):
+            try:
+                listener(apps)
+            except Exception:
+                logger.exception("status cache listener failed")
+
+    def touch(self):
+        self._last_update = time.monotonic()
+        STATUS_CACHE_LAST_UPDATE.set(time.time())
+
+    def replace(self, kind, items, key_func):
+        index, keys = {}, {}
+        for item in items:
+            app = key_func(item)
+            if app:
+                index.setdefault(app, {})[item.metadata.name] = item
+                keys[item.metadata.name] = app
+        with self._lock:
+            self._objects[kind] = index
+            self._keys[kind] = keys
+            self.generation += 1
+            self._epoch += 1
+            self._app_versions.clear()
+        STATUS_CACHE_OBJECTS.labels(kind=kind).set(len(keys))
+        self.touch()
+        self._notify(None)
+
+    def apply(self, kind, event_type, item, key_func):
+        name = item.metadata.name
+        app = key_func(item)
+        with self._lock:
+            index = self._objects[kind]
+            keys = self._keys[kind]
+            previous = keys.pop(name, None)
+            if previous is not None:
+                objects = index.get(previous, {})
+                objects.pop(name, None)
+                if not objects:
+                    index.pop(previous, None)
+            if app and event_type != "DELETED":
+                index.setdefault(app, {})[name] = item
+                keys[name] = app
+            count = len(keys)
+            self.generation += 1
+            changed = {previous, app} - {None}
+            for changed_app in changed:
+                self._app_versions[changed_app] = self._app_versions.get(changed_app, 0) + 1
+        STATUS_CACHE_OBJECTS.labels(kind=kind).set(count)
+        self.touch()
+        if changed:
+            self._notify(changed)
+
+    def version(self, app_name):
+        """Changes whenever anything cached for `app_name` does."""
+        with self._lock:
+            return self._epoch, self._app_versions.get(app_name, 0)
+
+    def get_app(self, app_name):
+        with self._lock:
+            stateful_sets = self._objects["statefulset"].get(app_name)
+            if not stateful_sets:
+                return None
+            pods = list(self._objects["pod"].get(app_name, {}).values())
+            stateful_set = next(iter(stateful_sets.values()))
+        return stateful_set, sorted(pods, key=lambda pod: pod.metadata.name)
+
+    def list_apps(self):
+        with self._lock:
+            apps = [(app, stateful_set, list(self._objects["pod"].get(app, {}).values()))
+                    for app, stateful_sets in self._objects["statefulset"].items()
+                    for stateful_set in stateful_sets.values()]
+        apps.sort(key=lambda entry: entry[1].metadata.name)
+        return [(app, stateful_set, sorted(pods, key=lambda pod: pod.metadata.name))
+                for app, stateful_set, pods in apps]
@@ -0,0 +1,160 @@
+import os
+import asyncio
+import logging
+import orjson
+from prometheus_client import Counter, Gauge
+from status_snapshots import app_status
+
+logger = logging.getLogger(__name__)
+
+# Events a client may fall behind by before its backlog is dropped and it's sent a fresh snapshot
+STATUS_STREAM_CLIENT_BUFFER = int(os.getenv("STATUS_STREAM_CLIENT_BUFFER", "100"))
+STATUS_STREAM_MAX_SUBSCRIBERS = int(os.getenv("STATUS_STREAM_MAX_SUBSCRIBERS", "1000"))
+# Cache changes arriving within this window go out as one delta per app
+STATUS_STREAM_COALESCE_SECONDS = float(os.getenv("STATUS_STREAM_COALESCE_SECONDS", "0.1"))
+STATUS_STREAM_HEARTBEAT_SECONDS = float(os.getenv("STATUS_STREAM_HEARTBEAT_SECONDS", "15"))
+STATUS_STREAM_RETRY_MILLISECONDS = 5000
+
+STATUS_STREAM_SUBSCRIBERS = Gauge("status_stream_subscribers", "Clients connected to /status/stream",
+                                  multiprocess_mode="livesum")
+STATUS_STREAM_EVENTS = Counter("status_stream_events_total", "Events published to /status/stream", ["event"])
+STATUS_STREAM_RESYNCS = Counter("status_stream_resyncs_total",
+                                "Clients whose buffer overflowed and were sent a fresh snapshot instead")
+
+
+class _Subscriber:
+
+    def __init__(self, buffer_size):
+        self.queue = asyncio.Queue(maxsize=buffer_size)
+
+
+class StatusFeed:
+    """Turns status cache changes into per-app deltas and fans them out to /status/stream clients.
+
+    The feed keeps the last status it published for every app. A delta goes out only when an app's status has
+    actually changed, and a new or resynced client's snapshot is built from that same published state, so a client
+    applying its snapshot and then every delta in order always ends up where the feed is. Each event is encoded
+    once however many clients are connected.
+    """
+
+    def __init__(self, status_cache, buffer_size=STATUS_STREAM_CLIENT_BUFFER):
+        self.status_cache = status_cache
+        self.buffer_size = buffer_size
+        self.apps = {}
+        self.ready = asyncio.Event()
+        self._subscribers = set()
+        self._pending = set()
+        self._relist = False
+        self._flush_handle = None
+        self._loop = None
+        self._event_id = 0
+        self._snapshot = None
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self.status_cache.add_listener(self._changed)
+        # Covers lists that finished before the listener was added
+        self._changed(None)
+
+    def stop(self):
+        self.status_cache.remove_listener(self._changed)
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        for subscriber in self._subscribers:
+            self._offer(subscriber, None)
+
+    def _changed(self, apps):
+        if apps is None:
+            self._relist = True
+        else:
+            self._pending.update(apps)
+        if self._flush_handle is None:
+            self._flush_handle = self._loop.call_later(STATUS_STREAM_COALESCE_SECONDS, self._flush)
+
+    def _current(self, app_name):
+        found = self.status_cache.get_app(app_name)
+        if found is None:
+            return None
+        deployment, pods = found
+        return app_status(app_name, deployment, pods)
+
+    def _flush(self):
+        self._flush_handle = None
+        if self._relist:
+            current = {name: app_status(name, deployment, pods)
+                       for name, deployment, pods in self.status_cache.list_apps()}
+            names = set(self.apps) | set(current)
+        else:
+            current = {name: self._current(name) for name in self._pending}
+            names = self._pending
+        self._relist = False
+        self._pending = set()
+
+        for name in sorted(names):
+            status = current.get(name)
+            if status == self.apps.get(name):
+                continue
+            if status is None:
+                del self.apps[name]
+            else:
+                self.apps[name] = status
+            self._snapshot = None
+            self._publish("app", {"app": name, "status": status})
+
+        if not self.ready.is_set() and self.status_cache.synced:
+            self.ready.set()
+
+    def _encode(self, event, data):
+        self._event_id += 1
+        return b"id: %d\nevent: %s\ndata: %s\n\n" % (self._event_id, event.encode(), data)
+
+    def snapshot_event(self):
+        if self._snapshot is None:
+            body = orjson.dumps([self.apps[name] for name in sorted(self.apps)])
+            self._snapshot = self._encode("snapshot", body)
+        return self._snapshot
+
+    def _publish(self, event, data):
+        if not self._subscribers:
+            return
+        encoded = self._encode(event, orjson.dumps(data))
+        STATUS_STREAM_EVENTS.labels(event=event).inc()
+        for subscriber in self._subscribers:
+            self._offer(subscriber, encoded)
+
+    def _offer(self, subscriber, encoded):
+        try:
+            subscriber.queue.put_nowait(encoded)
+        except asyncio.QueueFull:
+            # Everything queued is superseded by the current state, so replace it with a snapshot of that
+            while not subscriber.queue.empty():
+                subscriber.queue.get_nowait()
+            subscriber.queue.put_nowait(self.snapshot_event() if encoded is not None else None)
+            STATUS_STREAM_RESYNCS.inc()
+
+    @property
+    def full(self):
+        return len(self._subscribers) >= STATUS_STREAM_MAX_SUBSCRIBERS
+
+    async def events(self):
+        """Encoded SSE events for one client: a snapshot, then deltas as they happen, with heartbeats between."""
+        yield b"retry: %d\n\n" % STATUS_STREAM_RETRY_MILLISECONDS
+        await self.ready.wait()
+        # Snapshot and subscription are taken together, so no delta falls between them
+        subscriber = _Subscriber(self.buffer_size)
+        self._subscribers.add(subscriber)
+        STATUS_STREAM_SUBSCRIBERS.inc()
+        try:
+            yield self.snapshot_event()
+            while True:
+                try:
+                    encoded = await asyncio.wait_for(subscriber.queue.get(), STATUS_STREAM_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield b": keepalive\n\n"
+                    continue
+                if encoded is None:
+                    return
+                yield encoded
+        finally:
+            self._subscribers.discard(subscriber)
+            STATUS_STREAM_SUBSCRIBERS.dec()
@@ -0,0 +1,117 @@
+import hashlib
+from typing import List, Optional
+import orjson
+from pydantic import BaseModel
+
+
+class PodStatus(BaseModel):
+    Name: str
+    Phase: Optional[str] = None
+    HostIP: Optional[str] = None
+    PodIP: Optional[str] = None
+    StartTime: Optional[str] = None
+
+
+class PoolStatus(BaseModel):
+    Database: Optional[str] = None
+    User: Optional[str] = None
+    PoolMode: Optional[str] = None
+    ClientsActive: Optional[int] = None
+    ClientsWaiting: Optional[int] = None
+    ServersActive: Optional[int] = None
+    ServersIdle: Optional[int] = None
+    ServersUsed: Optional[int] = None
+    MaxWaitSeconds: Optional[int] = None
+
+
+class PoolerStatus(BaseModel):
+    Pools: List[PoolStatus]
+    Error: Optional[str] = None
+
+
+class AppStatus(BaseModel):
+    DeploymentName: str
+    Replicas: Optional[int] = None
+    ReadyReplicas: Optional[int] = None
+    PodStatuses: List[PodStatus]
+    # Only for apps with a PgBouncer sidecar, and only on /status/{app_name}
+    Pooler: Optional[PoolerStatus] = None
+
+
+def pod_status(pod):
+    return {
+        "Name": pod.metadata.name,
+        "Phase": pod.status.phase if pod.status else None,
+        "HostIP": pod.status.host_ip if pod.status else None,
+        "PodIP": pod.status.pod_ip if pod.status else None,
+        "StartTime": pod.status.start_time.strftime('%Y-%m-%d %H:%M:%S') if pod.status and pod.status.start_time else None
+    }
+
+
+def app_status(deployment_name, deployment, pods):
+    return {
+        "DeploymentName": deployment_name,
+        "Replicas": deployment.spec.replicas,
+        # Status is unset until the controller first reconciles a new StatefulSet
+        "ReadyReplicas": deployment.status.ready_replicas if deployment.status else None,
+        "PodStatuses": [pod_status(pod) for pod in pods]
+    }
+
+
+class Snapshot:
+    """An encoded response body and its ETag."""
+
+    def __init__(self, body):
+        self.body = body
+        self.etag = f'"{hashlib.blake2b(body, digest_size=12).hexdigest()}"'
+
+    def matches(self, if_none_match):
+        if not if_none_match:
+            return False
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return "*" in tags or self.etag in tags
+
+
+class StatusSnapshots:
+    """Encoded /status/ and /status/{app_name} bodies, rebuilt only after the status cache has changed.
+
+    The full listing is keyed by the cache's generation and each app by its own version, so a pod event in one
+    tenant leaves every other tenant's snapshot in place.
+    """
+
+    def __init__(self, status_cache):
+        self.status_cache = status_cache
+        self._all = None
+        self._apps = {}
+
+    def all(self):
+        generation = self.status_cache.generation
+        cached = self._all
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+        body = orjson.dumps([app_status(name, deployment, pods)
+                             for name, deployment, pods in self.status_cache.list_apps()])
+        snapshot = Snapshot(body)
+        # Labelled with the generation read before listing, so a change during the build forces another rebuild
+        self._all = (generation, snapshot)
+        return snapshot
+
+    def app(self, app_name):
+        """The app's snapshot, or None if the cache has no StatefulSet for it."""
+        version = self.status_cache.version(app_name)
+        cached = self._apps.get(app_name)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        found = self.status_cache.get_app(app_name)
+        if found is None:
+            self._apps.pop(app_name, None)
+            return None
+        deployment, pods = found
+        snapshot = Snapshot(orjson.dumps(app_status(deployment.metadata.name, deployment, pods)))
+        self._apps[app_name] = (version, snapshot)
+        return snapshot
+
+    def stream(self):
+        """Encoded lines for the NDJSON listing."""
+        for name, deployment, pods in self.status_cache.list_apps():
+            yield orjson.dumps(app_status(name, deployment, pods)) + b"\n"